@@ -0,0 +1,122 @@
+import os
+import numpy as np
+import torch
+import torchreid
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+from torchvision import transforms
+from tqdm import tqdm
+
+#### Docs:
+# Semantic duplicates for remove-reposts-and-duplicates.py: pHash misses cropped, re-compressed or watermarked reposts.
+# 1. Embed every image with OSNet (our Re-ID checkpoint, or small ImageNet-pretrained osnet_x0_25 if not given),
+#    embeddings are cached next to the pHash cache, so only new images are embedded on the next planning run
+# 2. Find cross-post image pairs with cosine similarity >= threshold. Exact search in blocks of matrix
+#    products is fast enough for our ~60k images on CPU, so no separate ANN library is needed
+
+
+class ImagePathsDataset(Dataset):
+    def __init__(self, img_paths, transform):
+        self.img_paths = img_paths
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.img_paths)
+
+    def __getitem__(self, idx):
+        img = Image.open(self.img_paths[idx]).convert('RGB')
+        return self.transform(img), idx
+
+
+def build_embedding_model(model_path, num_classes, device):
+    if model_path is None:
+        model = torchreid.models.build_model(name='osnet_x0_25', num_classes=1, loss='triplet', pretrained=True)
+    else:
+        model = torchreid.models.build_model(name='osnet_x1_0', num_classes=num_classes, loss='triplet',
+                                             pretrained=False)
+        state_dict = torch.load(model_path, map_location=device)['state_dict']
+        model.load_state_dict(state_dict)
+    model = model.to(device)
+    model.eval()
+    return model
+
+
+def embedding_model_id(model_path):
+    # Embeddings of different models are different spaces, the cache is only valid for the model that filled it
+    if model_path is None:
+        return 'osnet_x0_25:imagenet'
+    stat = os.stat(model_path)
+    return f"osnet_x1_0:{os.path.abspath(model_path)}:{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def compute_image_embeddings(img_paths, cache_path, model_path=None, num_classes=1, batch_size=64, num_workers=4):
+    """
+    Returns L2-normalised embeddings for img_paths (same order), embedding only images missing from cache_path.
+
+    Returns:
+        np.ndarray: float32 array of shape (len(img_paths), embedding_dim).
+    """
+    model_id = embedding_model_id(model_path)
+    cached = {}
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            cache_model_id = str(cache['model']) if 'model' in cache.files else None
+            if cache_model_id == model_id:
+                cached = dict(zip(cache['paths'].tolist(), cache['embeddings']))
+        if cached:
+            print(f"Loaded {len(cached)} image embeddings from file.")
+        else:
+            print(f"Image embeddings in {cache_path} are of another model ({cache_model_id}), embedding again.")
+
+    to_embed = [p for p in img_paths if p not in cached]
+    if to_embed:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        model = build_embedding_model(model_path, num_classes, device)
+        transform = transforms.Compose([
+            transforms.Resize((256, 128)),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=[0.485, 0.456, 0.406],  # ImageNet mean
+                                 std=[0.229, 0.224, 0.225]),  # ImageNet std
+        ])
+        loader = DataLoader(ImagePathsDataset(to_embed, transform), batch_size=batch_size, shuffle=False,
+                            num_workers=num_workers)
+        with torch.no_grad():
+            for imgs, indices in tqdm(loader, desc="Embedding images"):
+                features = torch.nn.functional.normalize(model(imgs.to(device)), dim=1).cpu().numpy()
+                for idx, feature in zip(indices.tolist(), features):
+                    cached[to_embed[idx]] = feature.astype(np.float32)
+
+        paths = list(cached.keys())
+        np.savez(cache_path, paths=np.array(paths), embeddings=np.stack([cached[p] for p in paths]),
+                 model=np.array(model_id))
+        print(f"Image embeddings computed for {len(to_embed)} new images and saved.")
+
+    return np.stack([cached[p] for p in img_paths])
+
+
+def find_similar_post_pairs_by_embeddings(embeddings, post_ids, threshold, block_size=1024):
+    """
+    Finds pairs of posts having at least one pair of images with cosine similarity >= threshold.
+
+    Args:
+        embeddings (np.ndarray): L2-normalised image embeddings.
+        post_ids (list): Post id of every embedding row.
+        threshold (float): Cosine similarity threshold.
+        block_size (int): Rows compared at once, bounds the memory of the similarity block.
+
+    Returns:
+        set: Pairs (post_id1, post_id2) with post_id1 < post_id2.
+    """
+    unique_post_ids, post_codes = np.unique(np.array(post_ids), return_inverse=True)
+    pairs = set()
+    for start in tqdm(range(0, len(embeddings), block_size), desc="Searching embedding neighbours"):
+        block = embeddings[start:start + block_size]
+        sims = block @ embeddings.T
+        rows = np.arange(start, start + len(block))[:, None]
+        cols = np.arange(len(embeddings))[None, :]
+        # Upper triangle only, different posts only
+        matches = (sims >= threshold) & (cols > rows) & (post_codes[rows] != post_codes[cols])
+        for i, j in zip(*np.nonzero(matches)):
+            post_id1, post_id2 = unique_post_ids[post_codes[start + i]], unique_post_ids[post_codes[j]]
+            pairs.add((min(post_id1, post_id2), max(post_id1, post_id2)))
+    return {(str(p1), str(p2)) for p1, p2 in pairs}
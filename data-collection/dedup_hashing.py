@@ -0,0 +1,54 @@
+import os
+from PIL import Image
+import imagehash
+
+#### Docs:
+# Perceptual hash helpers shared by remove-reposts-and-duplicates.py and its sharded workers (dedup_shards.py)
+
+HASH_BITS = 64  # imagehash.phash default hash_size=8
+
+
+def glob_images_in_directory(directory):
+    image_extensions = ('.jpg', '.jpeg', '.png', '.gif', '.bmp')
+    image_paths = []
+    for root, _, files in os.walk(directory):
+        for file in files:
+            if file.lower().endswith(image_extensions):
+                image_paths.append(os.path.join(root, file))
+    return image_paths
+
+
+def compute_phash(image_path):
+    try:
+        with Image.open(image_path) as img:
+            img = img.convert('RGB')
+            img_hash = imagehash.phash(img)
+        return img_hash
+    except Exception as e:
+        print(f"Error computing hash for {image_path}: {e}")
+        return None
+
+
+def get_post_id_from_path(image_path):
+    # Assuming filenames are in the format: prefix_groupid_postid_imgnum.ext
+    filename = os.path.basename(image_path)
+    base_name, _ = os.path.splitext(filename)
+    parts = base_name.split('_')
+    if len(parts) >= 3:
+        group_id = parts[-3]
+        post_id = parts[-2]
+        return f"{group_id}_{post_id}"
+    else:
+        return None
+
+
+def hash_to_int(img_hash):
+    return int(str(img_hash), 16)
+
+
+def hash_bands(hash_int, num_bands, num_bits=HASH_BITS):
+    # Pigeonhole: if two hashes differ in <= num_bands - 1 bits, at least one of num_bands bands is identical
+    band_size = -(-num_bits // num_bands)
+    band_mask = (1 << band_size) - 1
+    for band_ind in range(num_bands):
+        yield band_ind, (hash_int >> (band_ind * band_size)) & band_mask
@@ -0,0 +1,161 @@
+import os
+import json
+import shutil
+import hashlib
+
+#### Docs:
+# Plan + write-ahead journal for remove-reposts-and-duplicates.py
+# 1. Planning writes a JSON plan: clusters (keeper + duplicates) and a flat list of file actions
+# 2. Apply executes the actions one by one; every action is journaled as 'begin' (fsync-ed) before the file is
+#    touched and as 'done' after, so a crashed apply can be resumed by simply running it again
+# 3. Undo walks the journal backwards and moves every applied file back to where it was. It needs only the journal
+#    ('begin' records keep the paths of their action), so re-planning after an apply never makes the apply irreversible
+# Removed files are moved into a separate dir instead of being deleted, otherwise undo would be impossible.
+
+
+def save_plan(plan, plan_path):
+    plan['plan_id'] = compute_plan_id(plan['actions'])
+    with open(plan_path, 'w', encoding='utf-8') as f:
+        json.dump(plan, f, ensure_ascii=False)
+    print(f"Plan saved to {plan_path}: {len(plan['clusters'])} clusters, {len(plan['actions'])} file actions.")
+
+
+def load_plan(plan_path):
+    with open(plan_path, 'r', encoding='utf-8') as f:
+        plan = json.load(f)
+    if plan.get('plan_id') != compute_plan_id(plan['actions']):
+        raise ValueError(f"Plan file {plan_path} is corrupted or was edited after it was created")
+    return plan
+
+
+def compute_plan_id(actions):
+    actions_str = json.dumps(actions, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(actions_str.encode('utf-8')).hexdigest()
+
+
+def read_journal(journal_path):
+    """
+    Reads the journal and returns the id of the plan it belongs to, the per-action states and paths.
+
+    Returns:
+        tuple: (plan_id or None, dict action index -> last state, list of action indices in the order they were done,
+        dict action index -> (src, dst) of its 'begin' record)
+    """
+    plan_id = None
+    states = {}
+    done_order = []
+    paths = {}
+    if not os.path.exists(journal_path):
+        return plan_id, states, done_order, paths
+    with open(journal_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Only the very last line can be torn by a crash, the action it describes is re-checked on resume
+                print(f"Skipping torn journal line: {line}")
+                continue
+            if 'plan_id' in entry:
+                plan_id = entry['plan_id']
+                continue
+            states[entry['i']] = entry['state']
+            if entry['state'] == 'begin':
+                paths[entry['i']] = (entry['src'], entry['dst'])
+            elif entry['state'] == 'done':
+                done_order.append(entry['i'])
+    return plan_id, states, done_order, paths
+
+
+class Journal:
+    def __init__(self, journal_path):
+        self.file = open(journal_path, 'a', encoding='utf-8')
+
+    def write(self, entry, sync=False):
+        self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def apply_plan(plan, journal_path):
+    """
+    Executes plan actions, skipping the ones the journal already marks as done.
+    An action interrupted between 'begin' and 'done' is finished if its source file is still in place.
+    """
+    journal_plan_id, states, _, _ = read_journal(journal_path)
+    if journal_plan_id is not None and journal_plan_id != plan['plan_id']:
+        raise ValueError(f"Journal {journal_path} belongs to another plan ({journal_plan_id}), "
+                         f"undo it or move it away before applying plan {plan['plan_id']}")
+
+    journal = Journal(journal_path)
+    if journal_plan_id is None:
+        journal.write({'plan_id': plan['plan_id']}, sync=True)
+
+    applied, skipped, missing = 0, 0, 0
+    try:
+        for i, action in enumerate(plan['actions']):
+            if states.get(i) == 'done':
+                skipped += 1
+                continue
+            src, dst = action['src'], action['dst']
+            if states.get(i) == 'begin' and not os.path.exists(src) and os.path.exists(dst):
+                # Crashed right after the move, only the 'done' record is missing
+                journal.write({'i': i, 'state': 'done'})
+                applied += 1
+                continue
+            if not os.path.exists(src):
+                print(f"File already moved or missing: {src}")
+                journal.write({'i': i, 'state': 'missing'})
+                missing += 1
+                continue
+
+            journal.write({'i': i, 'op': action['op'], 'src': src, 'dst': dst, 'state': 'begin'}, sync=True)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            shutil.move(src, dst)
+            journal.write({'i': i, 'state': 'done'})
+            applied += 1
+    finally:
+        journal.close()
+    print(f"Plan applied: {applied} actions executed, {skipped} already done, {missing} missing files.")
+
+
+def undo_plan(journal_path):
+    """
+    Reverts every action the journal marks as done, newest first, with the paths recorded in the journal, so the plan
+    file may have been replaced since the apply.
+    """
+    journal_plan_id, states, done_order, paths = read_journal(journal_path)
+    if journal_plan_id is None:
+        print(f"Nothing to undo, journal {journal_path} is empty.")
+        return
+
+    journal = Journal(journal_path)
+    reverted = 0
+    try:
+        for i in reversed(done_order):
+            if states.get(i) not in ('done', 'undo_begin'):
+                continue  # Was undone by a previous (interrupted) undo run
+            src, dst = paths[i]
+            if states.get(i) == 'undo_begin' and not os.path.exists(dst) and os.path.exists(src):
+                journal.write({'i': i, 'state': 'undone'})
+                states[i] = 'undone'
+                reverted += 1
+                continue
+            if not os.path.exists(dst):
+                print(f"Cannot undo, file is missing: {dst}")
+                continue
+            journal.write({'i': i, 'state': 'undo_begin'}, sync=True)
+            os.makedirs(os.path.dirname(src), exist_ok=True)
+            shutil.move(dst, src)
+            journal.write({'i': i, 'state': 'undone'})
+            states[i] = 'undone'
+            reverted += 1
+    finally:
+        journal.close()
+    print(f"Undo complete: {reverted} actions reverted.")
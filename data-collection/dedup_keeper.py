@@ -0,0 +1,116 @@
+import os
+import json
+import multiprocessing
+from collections import defaultdict
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+#### Docs:
+# Keeper policies for duplicate clusters of remove-reposts-and-duplicates.py, every policy returns one keeper per cluster.
+# - most_images: the post with the most distinct images (the original behaviour)
+# - quality: weighted score of per-post features, every feature is min-max normalised within the cluster:
+#   - images: number of distinct images
+#   - resolution: mean megapixels of the images
+#   - sharpness: median variance of the Laplacian (blurry photos have low variance)
+#   - segmented: share of the images that segmentation succeeded on (have an output in the segmented dir)
+#   - earliest: earlier posts are the originals, reposts come later
+#   Image features are computed once for the images of clustered posts only, in a process pool, and cached.
+
+SHARPNESS_SIZE = 512  # Images are decoded at about this size for sharpness, JPEG draft mode makes it cheap
+
+
+def most_images_keepers(clusters, post_sizes):
+    return [max(cluster, key=lambda p: post_sizes[p]) for cluster in clusters], {}
+
+
+def image_quality(img_path):
+    try:
+        with Image.open(img_path) as img:
+            width, height = img.size
+            img.draft('L', (SHARPNESS_SIZE, SHARPNESS_SIZE))
+            gray = img.convert('L')
+            gray.thumbnail((SHARPNESS_SIZE, SHARPNESS_SIZE))
+            pixels = np.asarray(gray, dtype=np.float32)
+    except Exception as e:
+        print(f"Error computing quality for {img_path}: {e}")
+        return img_path, None
+    laplacian = (pixels[1:-1, :-2] + pixels[1:-1, 2:] + pixels[:-2, 1:-1] + pixels[2:, 1:-1]
+                 - 4 * pixels[1:-1, 1:-1])
+    return img_path, [width, height, float(laplacian.var())]
+
+
+def compute_images_quality(img_paths, cache_path, num_workers):
+    """
+    Returns:
+        dict: img_path -> [width, height, sharpness], images that failed to decode are missing.
+    """
+    quality = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            quality = json.load(f)
+
+    to_compute = [p for p in img_paths if p not in quality]
+    if to_compute:
+        with multiprocessing.Pool(num_workers) as pool:
+            for img_path, img_quality in tqdm(pool.imap_unordered(image_quality, to_compute, chunksize=64),
+                                              total=len(to_compute), desc="Scoring images quality"):
+                if img_quality is not None:
+                    quality[img_path] = img_quality
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump(quality, f)
+    return quality
+
+
+def post_features(post_id, img_paths, post_sizes, quality, segmented_files, post_dates):
+    img_quality = [quality[p] for p in img_paths if p in quality]
+    return {
+        'images': post_sizes[post_id],
+        'resolution': np.mean([w * h / 1e6 for w, h, _ in img_quality]) if img_quality else 0.0,
+        'sharpness': np.median([s for _, _, s in img_quality]) if img_quality else 0.0,
+        'segmented': (np.mean([os.path.basename(p) in segmented_files for p in img_paths])
+                      if segmented_files is not None and img_paths else 0.0),
+        # Posts missing from the index are treated as the latest ones
+        'earliest': -post_dates.get(post_id, float('inf')),
+    }
+
+
+def quality_keepers(clusters, post_sizes, post_images, weights, cache_path, num_workers, segmented_dir=None,
+                    post_dates=None):
+    """
+    Args:
+        clusters (list): Clusters of duplicate post ids.
+        post_sizes (dict): post_id -> number of distinct image hashes.
+        post_images (dict): post_id -> image paths, for clustered posts only.
+        weights (dict): feature name -> weight, see Docs above.
+        cache_path (str): File to save/load image quality features.
+        num_workers (int): Processes for the image quality pass.
+        segmented_dir (str): Flat dir with segmentation outputs named as the raw images, None to skip the feature.
+        post_dates (dict): post_id -> date_ts from the index, None to skip the feature.
+
+    Returns:
+        tuple: (keeper per cluster, dict post_id -> score)
+    """
+    img_paths = sorted(p for cluster in clusters for post_id in cluster for p in post_images.get(post_id, []))
+    quality = compute_images_quality(img_paths, cache_path, num_workers)
+    segmented_files = set(os.listdir(segmented_dir)) if segmented_dir is not None else None
+    post_dates = post_dates or {}
+
+    keepers, scores = [], {}
+    for cluster in clusters:
+        features = {post_id: post_features(post_id, post_images.get(post_id, []), post_sizes, quality,
+                                           segmented_files, post_dates)
+                    for post_id in cluster}
+        cluster_scores = defaultdict(float)
+        for feature, weight in weights.items():
+            values = np.array([features[post_id][feature] for post_id in cluster], dtype=np.float64)
+            finite = values[np.isfinite(values)]
+            if len(finite) == 0 or finite.max() == finite.min():
+                continue  # Feature doesn't tell the posts apart
+            normalised = (np.nan_to_num(values, neginf=finite.min()) - finite.min()) / (finite.max() - finite.min())
+            for post_id, value in zip(cluster, normalised):
+                cluster_scores[post_id] += weight * value
+        # Ties are resolved the old way, by the number of images
+        keepers.append(max(cluster, key=lambda p: (cluster_scores[p], post_sizes[p])))
+        scores.update({post_id: round(cluster_scores[post_id], 3) for post_id in cluster})
+    return keepers, scores
@@ -0,0 +1,202 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from dedup_hashing import glob_images_in_directory, compute_phash, get_post_id_from_path, hash_to_int, HASH_BITS
+
+#### Docs:
+# Sharded mode of remove-reposts-and-duplicates.py for corpora that don't fit one process.
+# Posts never span _part_N dirs, so every part is a shard:
+# 1. hash_shard (one process per shard): pHash the shard (cached per shard), do intra-post and special ads dedup,
+#    then write the kept rows and their hash bands to disk, bands are split into NUM_PARTITIONS files by band value
+# 2. pair_partition (one process per partition): join the same partition of all shards, compare only the images
+#    sharing a band and write the similar post pairs to disk
+# 3. The main process streams the pair files into the global union-find over posts (not images)
+# So peak memory of a worker is ~ one shard or one partition, and of the main process ~ number of posts.
+# Posts are encoded as int64: shard index << 32 | post index within the shard.
+# Buckets are compared in blocks of BUCKET_BLOCK_ROWS rows, buckets over MAX_BUCKET_SIZE images (one band value shared
+# by blank or near-uniform images) are skipped and reported: their pairs are noise and would grow quadratically.
+
+BUCKET_BLOCK_ROWS = 1024
+MAX_BUCKET_SIZE = 20000
+
+
+def shard_name(shard_ind, shard_dir):
+    return f"{shard_ind:03d}{os.path.basename(os.path.normpath(shard_dir))}"
+
+
+def load_shard_hashes(shard_dir, cache_path):
+    cached = {}
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            cached = dict(zip(cache['paths'].tolist(), cache['hashes'].tolist()))
+
+    paths, hashes = [], []
+    for img_path in sorted(glob_images_in_directory(shard_dir)):
+        hash_int = cached.get(img_path)
+        if hash_int is None:
+            img_hash = compute_phash(img_path)
+            if img_hash is None:
+                continue
+            hash_int = hash_to_int(img_hash)
+        paths.append(img_path)
+        hashes.append(hash_int)
+    np.savez(cache_path, paths=np.array(paths, dtype=str), hashes=np.array(hashes, dtype=np.uint64))
+    return paths, hashes
+
+
+def hash_shard(shard_ind, shard_dir, out_dir, special_hashes, intra_threshold, inter_threshold, num_partitions):
+    name = shard_name(shard_ind, shard_dir)
+    paths, hashes = load_shard_hashes(shard_dir, os.path.join(out_dir, f'{name}.hashes.npz'))
+
+    # Intra-post dedup, first image (by path) of similar ones is kept
+    removed = {}
+    post_unique_hashes = {}
+    for img_path, hash_int in zip(paths, hashes):
+        post_id = get_post_id_from_path(img_path)
+        if post_id is None:
+            continue
+        unique_hashes = post_unique_hashes.setdefault(post_id, [])
+        if any((hash_int ^ u_hash).bit_count() <= intra_threshold for u_hash in unique_hashes):
+            removed[img_path] = 'intra_post'
+        else:
+            unique_hashes.append(hash_int)
+
+    # Special ads
+    if special_hashes:
+        specials = np.array(special_hashes, dtype=np.uint64)
+        hashes_arr = np.array(hashes, dtype=np.uint64)
+        is_ad = (np.bitwise_count(hashes_arr[:, None] ^ specials[None, :]) <= intra_threshold).any(axis=1)
+        for img_path in np.array(paths, dtype=str)[is_ad].tolist():
+            removed.setdefault(img_path, 'special_ad')
+
+    post_names = sorted(post_unique_hashes)
+    post_codes = {post_id: (shard_ind << 32) | i for i, post_id in enumerate(post_names)}
+    kept = [(p, h) for p, h in zip(paths, hashes) if p not in removed and get_post_id_from_path(p) is not None]
+    kept_paths = np.array([p for p, _ in kept], dtype=str)
+    kept_hashes = np.array([h for _, h in kept], dtype=np.uint64)
+    kept_post_codes = np.array([post_codes[get_post_id_from_path(p)] for p, _ in kept], dtype=np.int64)
+    # Number of distinct hashes per post, what the keeper selection compares
+    post_sizes = np.zeros(len(post_names), dtype=np.int64)
+    if len(kept_hashes):
+        unique_rows = np.unique(np.stack([kept_post_codes & 0xFFFFFFFF, kept_hashes.view(np.int64)], axis=1), axis=0)
+        np.add.at(post_sizes, unique_rows[:, 0], 1)
+    np.savez(os.path.join(out_dir, f'{name}.shard.npz'),
+             paths=kept_paths, post_codes=kept_post_codes,
+             post_names=np.array(post_names, dtype=str), post_sizes=post_sizes,
+             removed_paths=np.array(list(removed.keys()), dtype=str),
+             removed_reasons=np.array(list(removed.values()), dtype=str))
+
+    # Hash bands, split into partitions by band value so a partition can be joined across all shards
+    num_bands = inter_threshold + 1
+    band_size = -(-HASH_BITS // num_bands)
+    band_mask = np.uint64((1 << band_size) - 1)
+    band_inds = np.repeat(np.arange(num_bands, dtype=np.uint8), len(kept_hashes))
+    band_keys = np.concatenate([(kept_hashes >> np.uint64(b * band_size)) & band_mask for b in range(num_bands)])
+    partitions = (band_keys % np.uint64(num_partitions)).astype(np.int64)
+    all_hashes = np.tile(kept_hashes, num_bands)
+    all_post_codes = np.tile(kept_post_codes, num_bands)
+    for partition_ind in range(num_partitions):
+        in_partition = partitions == partition_ind
+        np.savez(os.path.join(out_dir, f'{name}.bands_{partition_ind}.npz'),
+                 band_inds=band_inds[in_partition], band_keys=band_keys[in_partition],
+                 hashes=all_hashes[in_partition], post_codes=all_post_codes[in_partition])
+
+    print(f"Shard {name}: {len(paths)} images hashed, {len(removed)} to remove, {len(post_names)} posts.")
+    return name
+
+
+def pair_partition(partition_ind, shard_names, out_dir, inter_threshold):
+    band_inds, band_keys, hashes, post_codes = [], [], [], []
+    for name in shard_names:
+        with np.load(os.path.join(out_dir, f'{name}.bands_{partition_ind}.npz')) as bands:
+            band_inds.append(bands['band_inds'])
+            band_keys.append(bands['band_keys'])
+            hashes.append(bands['hashes'])
+            post_codes.append(bands['post_codes'])
+    band_inds, band_keys = np.concatenate(band_inds), np.concatenate(band_keys)
+    hashes, post_codes = np.concatenate(hashes), np.concatenate(post_codes)
+
+    # Sort by (band, value) so every bucket is a contiguous run
+    order = np.lexsort((band_keys, band_inds))
+    band_inds, band_keys, hashes, post_codes = band_inds[order], band_keys[order], hashes[order], post_codes[order]
+    boundaries = np.flatnonzero((np.diff(band_inds) != 0) | (np.diff(band_keys) != 0)) + 1
+    starts, ends = np.r_[0, boundaries], np.r_[boundaries, len(hashes)]
+
+    pairs = []
+    for start, end in zip(starts, ends):
+        if end - start < 2:
+            continue
+        if end - start > MAX_BUCKET_SIZE:
+            print(f"Partition {partition_ind}: skipping a bucket of {end - start} images (band {band_inds[start]}, "
+                  f"value {band_keys[start]}), likely blank or near-uniform images.")
+            continue
+        bucket_hashes, bucket_posts = hashes[start:end], post_codes[start:end]
+        # Every block of rows against the rows after its first one, memory ~ BUCKET_BLOCK_ROWS x bucket size
+        for block_start in range(0, len(bucket_hashes) - 1, BUCKET_BLOCK_ROWS):
+            rows = slice(block_start, block_start + BUCKET_BLOCK_ROWS)
+            cols = slice(block_start, None)
+            similar = np.bitwise_count(bucket_hashes[rows, None] ^ bucket_hashes[None, cols]) <= inter_threshold
+            similar &= bucket_posts[rows, None] != bucket_posts[None, cols]
+            i, j = np.nonzero(np.triu(similar, 1))
+            if len(i):
+                i, j = bucket_posts[rows][i], bucket_posts[cols][j]
+                pairs.append(np.unique(np.stack([np.minimum(i, j), np.maximum(i, j)], axis=1), axis=0))
+    pairs = np.unique(np.concatenate(pairs), axis=0) if pairs else np.empty((0, 2), dtype=np.int64)
+
+    pairs_path = os.path.join(out_dir, f'pairs_{partition_ind}.npy')
+    np.save(pairs_path, pairs)
+    return pairs_path
+
+
+def run_sharded_hashing(shard_dirs, out_dir, special_hashes, intra_threshold, inter_threshold, num_workers,
+                        num_partitions):
+    """
+    Runs both sharded phases in a process pool.
+
+    Returns:
+        tuple: (shard names, paths of the post pairs files)
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    num_shards = len(shard_dirs)
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        shard_names = list(pool.map(hash_shard, range(num_shards), shard_dirs, [out_dir] * num_shards,
+                                    [special_hashes] * num_shards, [intra_threshold] * num_shards,
+                                    [inter_threshold] * num_shards, [num_partitions] * num_shards))
+        pairs_paths = list(pool.map(pair_partition, range(num_partitions), [shard_names] * num_partitions,
+                                    [out_dir] * num_partitions, [inter_threshold] * num_partitions))
+    return shard_names, pairs_paths
+
+
+def load_shards_posts(shard_names, out_dir):
+    """
+    Returns:
+        tuple: (dict post code -> post id, dict post id -> number of distinct image hashes)
+    """
+    code_to_post_id, post_sizes = {}, {}
+    for shard_ind, name in enumerate(shard_names):
+        with np.load(os.path.join(out_dir, f'{name}.shard.npz')) as shard:
+            for i, (post_id, size) in enumerate(zip(shard['post_names'].tolist(), shard['post_sizes'].tolist())):
+                code_to_post_id[(shard_ind << 32) | i] = post_id
+                if size > 0:  # All images of the post may be removed by intra-post or special ads dedup
+                    post_sizes[post_id] = size
+    return code_to_post_id, post_sizes
+
+
+def iter_shards_removed_images(shard_names, out_dir):
+    for name in shard_names:
+        with np.load(os.path.join(out_dir, f'{name}.shard.npz')) as shard:
+            yield from zip(shard['removed_paths'].tolist(), shard['removed_reasons'].tolist())
+
+
+def iter_shards_post_images(shard_names, out_dir, code_to_post_id):
+    for name in shard_names:
+        with np.load(os.path.join(out_dir, f'{name}.shard.npz')) as shard:
+            for img_path, post_code in zip(shard['paths'].tolist(), shard['post_codes'].tolist()):
+                yield code_to_post_id[post_code], img_path
+
+
+def iter_post_pairs(pairs_paths, code_to_post_id):
+    for pairs_path in pairs_paths:
+        for code1, code2 in np.load(pairs_path).tolist():
+            post_id1, post_id2 = code_to_post_id[code1], code_to_post_id[code2]
+            yield min(post_id1, post_id2), max(post_id1, post_id2)
@@ -0,0 +1,114 @@
+import re
+import json
+import zlib
+from collections import defaultdict
+import numpy as np
+
+#### Docs:
+# Text reposts for remove-reposts-and-duplicates.py: reposts between VK groups usually carry near-identical text.
+# 1. Normalise post texts (lowercase, no links/mentions/punctuation) and split into character shingles
+# 2. MinHash every text into NUM_PERM values, near-identical texts share most of them
+# 3. LSH: split the signature into bands, only posts sharing a whole band become candidates (near-linear time),
+#    candidates are kept if their estimated Jaccard similarity is above the threshold
+
+SHINGLE_SIZE = 5  # Characters per shingle
+NUM_PERM = 128  # MinHash signature length
+NUM_BANDS = 16  # LSH bands, NUM_PERM / NUM_BANDS rows per band, catches pairs with Jaccard >~ 0.7
+MIN_SHINGLES = 30  # Shorter texts ("Найдена собака!") are too generic to tell reposts apart
+MAX_BUCKET_SIZE = 200  # Bigger buckets are templated group texts, not reposts
+
+MERSENNE_PRIME = (1 << 31) - 1
+_rng = np.random.RandomState(42)
+PERM_A = _rng.randint(1, MERSENNE_PRIME, size=NUM_PERM).astype(np.uint64)
+PERM_B = _rng.randint(0, MERSENNE_PRIME, size=NUM_PERM).astype(np.uint64)
+
+
+def load_index_field(index_file, field):
+    """
+    Loads one field of every post from the index file (JSON Lines).
+
+    Returns:
+        dict: Mapping from post id as used in dedup ('vkg<GROUP_ID>_<POST_ID>') to the field value, posts without
+        the field are skipped.
+    """
+    values = {}
+    with open(index_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                post = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping invalid JSON line: {line}")
+                continue
+            group_id = str(post.get('group_id')).replace('-', '')
+            post_id = str(post.get('post_id')).replace('-', '')
+            if post.get(field):
+                values[f"vkg{group_id}_{post_id}"] = post[field]
+    return values
+
+
+def load_post_texts(index_file):
+    return load_index_field(index_file, 'text')
+
+
+def normalise_text(text):
+    text = text.lower()
+    text = re.sub(r'https?://\S+|vk\.com/\S+', ' ', text)  # Links
+    text = re.sub(r'\[(id|club|public)\d+\|[^\]]*\]', ' ', text)  # VK mentions: [id123|Name]
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return ' '.join(text.split())
+
+
+def minhash(text):
+    shingles = {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+    if len(shingles) < MIN_SHINGLES:
+        return None
+    shingle_hashes = np.fromiter((zlib.crc32(s.encode('utf-8')) & MERSENNE_PRIME for s in shingles),
+                                 dtype=np.uint64, count=len(shingles))
+    # (a * x + b) mod p for all permutations at once, a and x are < 2^31 so no uint64 overflow
+    return ((PERM_A[:, None] * shingle_hashes[None, :] + PERM_B[:, None]) % MERSENNE_PRIME).min(axis=1)
+
+
+def find_similar_post_pairs_by_text(post_texts, jaccard_threshold):
+    """
+    Finds pairs of posts with near-identical texts.
+
+    Args:
+        post_texts (dict): post_id -> raw post text.
+        jaccard_threshold (float): Min estimated Jaccard similarity of text shingles.
+
+    Returns:
+        set: Pairs (post_id1, post_id2) with post_id1 < post_id2.
+    """
+    signatures = {}
+    for post_id, text in post_texts.items():
+        signature = minhash(normalise_text(text))
+        if signature is not None:
+            signatures[post_id] = signature
+
+    rows_per_band = NUM_PERM // NUM_BANDS
+    buckets = defaultdict(list)
+    for post_id, signature in signatures.items():
+        for band_ind in range(NUM_BANDS):
+            band = signature[band_ind * rows_per_band:(band_ind + 1) * rows_per_band]
+            buckets[(band_ind, band.tobytes())].append(post_id)
+
+    pairs = set()
+    skipped_buckets = 0
+    for bucket in buckets.values():
+        if len(bucket) > MAX_BUCKET_SIZE:
+            skipped_buckets += 1
+            continue
+        for i in range(len(bucket)):
+            for j in range(i + 1, len(bucket)):
+                pair = (min(bucket[i], bucket[j]), max(bucket[i], bucket[j]))
+                if pair in pairs:
+                    continue
+                similarity = np.mean(signatures[pair[0]] == signatures[pair[1]])
+                if similarity >= jaccard_threshold:
+                    pairs.add(pair)
+    print(f"Text MinHash: {len(signatures)} posts with long enough text, {len(pairs)} similar pairs, "
+          f"{skipped_buckets} templated-text buckets skipped.")
+    return pairs
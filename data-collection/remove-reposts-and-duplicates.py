@@ -1,17 +1,27 @@
 import os
 import sys
-import signal
 import pickle
+import multiprocessing
 from collections import defaultdict
-from PIL import Image
-import imagehash
-import shutil
+from dedup_hashing import glob_images_in_directory, compute_phash, get_post_id_from_path, hash_to_int, hash_bands
+from dedup_journal import save_plan, load_plan, apply_plan, undo_plan
+from dedup_text import load_post_texts, load_index_field, find_similar_post_pairs_by_text
+from dedup_keeper import most_images_keepers, quality_keepers
 
 #### Docs:
 # Using Perceptual Hash model (pre-trained, used via imagehash lib):
 # 1. Deduplicate imgs within each post
 # 2. Deduplicate static images similar to what found in SPECIAL_ADS_DIRS
 # 3. Remove all the posts with __at least 1 image in common__ except the one with the most images
+#    (or the best one by quality score, see KEEPER_POLICY)
+#    (optionally "in common" also means close OSNet embeddings or near-identical post texts,
+#    see EMBEDDING_DEDUP and TEXT_DEDUP)
+#
+# Runs in one of three modes (MODE below or the first CLI argument):
+# - plan: only reads images/hashes and writes PLAN_FILE (clusters, keepers, removals), no files are touched.
+#   Cheap to rerun with other thresholds since hashes are cached in HASHES_FILE
+# - apply: executes PLAN_FILE with a write-ahead journal (JOURNAL_FILE), rerun it to resume after a crash
+# - undo: moves back every file the journal marks as applied, from the journal alone (PLAN_FILE may be replanned)
 
 # ----------------------- Configuration Parameters -----------------------
 
@@ -29,47 +39,48 @@ BASE_IMAGES_DIRs = [
     '/Users/albert.bikeev/Projects/sobaken-id/data/raw/vk_posts_dedup/_part_10'
 ]
 DUPLICATES_DIR = '/Users/albert.bikeev/Projects/sobaken-id/data/raw/vk_posts_dedup/duplicates_parts'
+REMOVED_DIR = '/Users/albert.bikeev/Projects/sobaken-id/data/raw/vk_posts_dedup/removed_parts'  # Instead of deleting
 SPECIAL_ADS_DIRS = [ '/Users/albert.bikeev/Projects/sobaken-id/data/raw/vk_posts_dedup/test/static_duplicates']
 HASHES_FILE = 'image_hashes.pkl'  # File to save/load image hashes
-PROGRESS_FILE = 'deduplication_progress.pkl'  # File to save/load progress
+PLAN_FILE = 'deduplication_plan.json'  # Output of the plan mode, input of apply/undo
+JOURNAL_FILE = 'deduplication_journal.jsonl'  # Write-ahead journal of the apply mode
+
+MODE = 'plan'  # 'plan', 'apply' or 'undo'
 
 # Thresholds
 INTRA_POST_THRESHOLD = 3  # Threshold for duplicates within a post
 INTER_POST_THRESHOLD = 3  # Threshold for duplicates between posts
 
-# ------------------------------------------------------------------------
+# Optional semantic duplicates (cropped, re-compressed, watermarked reposts), see dedup_embeddings.py
+EMBEDDING_DEDUP = False
+EMBEDDINGS_FILE = 'image_embeddings.npz'  # File to save/load image embeddings
+EMBEDDING_MODEL_PATH = None  # OSNet Re-ID checkpoint, None for ImageNet-pretrained osnet_x0_25
+EMBEDDING_MODEL_NUM_CLASSES = 621  # Must match the checkpoint
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_COSINE_THRESHOLD = 0.92  # Cosine similarity between posts' images to count them as duplicates
+
+# Optional text reposts (near-identical post texts in the index), see dedup_text.py
+TEXT_DEDUP = False
+INDEX_FILE = '/Users/albert.bikeev/Projects/sobaken-id/data/raw/vk_posts_dedup/index.json'
+TEXT_JACCARD_THRESHOLD = 0.8  # Estimated Jaccard similarity of post texts to count them as duplicates
+
+# Sharded mode: every BASE_IMAGES_DIRs entry is hashed by its own process, see dedup_shards.py
+SHARDED = False
+SHARDS_DIR = 'dedup_shards'  # Per-shard hashes, kept rows and band partitions
+NUM_WORKERS = multiprocessing.cpu_count()
+NUM_BAND_PARTITIONS = 16  # More partitions = less memory per pairing worker
+
+# Which post of a duplicate cluster is kept, see dedup_keeper.py
+KEEPER_POLICY = 'most_images'  # 'most_images' or 'quality'
+KEEPER_WEIGHTS = {'images': 1.0, 'resolution': 0.5, 'sharpness': 0.5, 'segmented': 1.0, 'earliest': 0.25}
+QUALITY_FILE = 'image_quality.json'  # File to save/load image resolution and sharpness
+SEGMENTED_DIR = None  # Flat dir of bulk-segment-and-clip.py outputs for the 'segmented' feature, None to skip it
 
-# Global variables for progress saving
-progress = {
-    'image_location_map': {},  # Mapping for image locations
-}
+# ------------------------------------------------------------------------
 
 # Global variable for all image hashes
 all_hashes = {}
 
-# Handle graceful exit
-def signal_handler(sig, frame):
-    print('Interrupt received, saving progress...')
-    save_progress()
-    sys.exit(0)
-
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
-
-def save_progress():
-    with open(PROGRESS_FILE, 'wb') as f:
-        pickle.dump(progress, f)
-    print("Progress saved.")
-
-def load_progress():
-    global progress
-    if os.path.exists(PROGRESS_FILE):
-        with open(PROGRESS_FILE, 'rb') as f:
-            progress = pickle.load(f)
-        print("Progress loaded.")
-    else:
-        print("No previous progress found. Starting fresh.")
-
 def compute_image_hashes():
     global all_hashes  # Declare as global to modify the global variable
     if os.path.exists(HASHES_FILE):
@@ -79,72 +90,44 @@ def compute_image_hashes():
     else:
         all_hashes = {}
         print("Computing image hashes...")
-        # Process base images
+        # Process base images and special ads images
         image_paths = []
-        for base_dir in BASE_IMAGES_DIRs:
+        for base_dir in BASE_IMAGES_DIRs + SPECIAL_ADS_DIRS:
             image_paths.extend(glob_images_in_directory(base_dir))
         for img_path in image_paths:
             img_hash = compute_phash(img_path)
             if img_hash is not None:
                 all_hashes[img_path] = img_hash
-                progress['image_location_map'][img_path] = img_path  # Initialize mapping
-
-        # Process special ads images
-        for special_dir in SPECIAL_ADS_DIRS:
-            image_paths = glob_images_in_directory(special_dir)
-            for img_path in image_paths:
-                img_hash = compute_phash(img_path)
-                if img_hash is not None:
-                    all_hashes[img_path] = img_hash
-                    progress['image_location_map'][img_path] = img_path  # Initialize mapping
 
         with open(HASHES_FILE, 'wb') as f:
             pickle.dump(all_hashes, f)
         print("Image hashes computed and saved.")
     return all_hashes
 
-def glob_images_in_directory(directory):
-    image_extensions = ('.jpg', '.jpeg', '.png', '.gif', '.bmp')
-    image_paths = []
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.lower().endswith(image_extensions):
-                image_paths.append(os.path.join(root, file))
-    return image_paths
-
-def compute_phash(image_path):
-    try:
-        with Image.open(image_path) as img:
-            img = img.convert('RGB')
-            img_hash = imagehash.phash(img)
-        return img_hash
-    except Exception as e:
-        print(f"Error computing hash for {image_path}: {e}")
-        return None
-
-def get_post_id_from_path(image_path):
-    # Assuming filenames are in the format: prefix_groupid_postid_imgnum.ext
-    filename = os.path.basename(image_path)
-    base_name, _ = os.path.splitext(filename)
-    parts = base_name.split('_')
-    if len(parts) >= 3:
-        group_id = parts[-3]
-        post_id = parts[-2]
-        return f"{group_id}_{post_id}"
-    else:
-        return None
+def removed_path(img_path):
+    # Same file names occur in different parts and groups: keep the path relative to its base dir, under a dir named
+    # after the base dir, so removed files never overwrite each other and undo can restore every one of them
+    for base_dir in BASE_IMAGES_DIRs + SPECIAL_ADS_DIRS:
+        rel_path = os.path.relpath(img_path, base_dir)
+        if not rel_path.startswith(os.pardir):
+            return os.path.join(REMOVED_DIR, os.path.basename(os.path.normpath(base_dir)), rel_path)
+    return os.path.join(REMOVED_DIR, os.path.splitdrive(os.path.abspath(img_path))[1].lstrip(os.sep))
+
+def removal_action(img_path, reason):
+    return {'op': 'remove', 'src': img_path, 'dst': removed_path(img_path), 'reason': reason}
 
-def deduplicate_within_posts():
-    print("Deduplicating images within posts...")
+def plan_within_posts_dedup():
+    print("Planning deduplication of images within posts...")
     posts = defaultdict(list)
     for img_path, img_hash in all_hashes.items():
         post_id = get_post_id_from_path(img_path)
         if post_id:
             posts[post_id].append((img_path, img_hash))
 
+    actions = []
     for post_id, img_list in posts.items():
         unique_hashes = {}
-        for img_path, img_hash in img_list:
+        for img_path, img_hash in sorted(img_list, key=lambda x: x[0]):
             duplicate_found = False
             for u_hash in unique_hashes.values():
                 if abs(img_hash - u_hash) <= INTRA_POST_THRESHOLD:
@@ -153,19 +136,12 @@ def deduplicate_within_posts():
             if not duplicate_found:
                 unique_hashes[img_path] = img_hash
             else:
-                # Remove duplicate image
-                current_path = progress['image_location_map'].get(img_path, img_path)
-                if os.path.exists(current_path):
-                    os.remove(current_path)
-                    print(f"Removed duplicate image within post {post_id}: {current_path}")
-                    del progress['image_location_map'][img_path]
-                    del all_hashes[img_path]
-                else:
-                    print(f"File already removed: {current_path}")
-    print("Intra-post deduplication complete.")
-
-def remove_special_ads_images():
-    print("Removing special ads images from base images...")
+                actions.append(removal_action(img_path, 'intra_post'))
+    print(f"Intra-post deduplication planned: {len(actions)} images to remove.")
+    return actions
+
+def plan_special_ads_removal():
+    print("Planning removal of special ads images from base images...")
     special_hashes = set()
     for special_dir in SPECIAL_ADS_DIRS:
         for img_path in glob_images_in_directory(special_dir):
@@ -173,31 +149,53 @@ def remove_special_ads_images():
             if img_hash:
                 special_hashes.add(img_hash)
 
-    for img_path in list(all_hashes.keys()):
+    actions = []
+    for img_path in sorted(all_hashes.keys()):
         if any([img_path.startswith(b) for b in BASE_IMAGES_DIRs]):
             img_hash = all_hashes[img_path]
             for special_hash in special_hashes:
                 if abs(img_hash - special_hash) <= INTRA_POST_THRESHOLD:
-                    # Remove the image if it exists
-                    current_path = progress['image_location_map'].get(img_path, img_path)
-                    if os.path.exists(current_path):
-                        os.remove(current_path)
-                        print(f"Removed special ad image: {current_path}")
-                        del progress['image_location_map'][img_path]
-                        del all_hashes[img_path]
-                    else:
-                        print(f"File already removed: {current_path}")
+                    actions.append(removal_action(img_path, 'special_ad'))
                     break
-    print("Special ads images removed.")
+    print(f"Special ads removal planned: {len(actions)} images to remove.")
+    return actions
 
-def deduplicate_across_posts():
-    print("Deduplicating images across posts...")
-    posts = defaultdict(set)
-    for img_path, img_hash in all_hashes.items():
-        post_id = get_post_id_from_path(img_path)
-        if post_id:
-            posts[post_id].add(img_hash)
+def find_similar_post_pairs(posts):
+    """
+    Finds pairs of posts with at least one pair of images within INTER_POST_THRESHOLD Hamming distance.
+    Images are bucketed by hash bands so only the images sharing a band are compared.
 
+    Args:
+        posts (dict): post_id -> set of image hashes.
+
+    Returns:
+        set: Pairs (post_id1, post_id2) with post_id1 < post_id2.
+    """
+    band_to_images = defaultdict(list)
+    for post_id, img_hashes in posts.items():
+        for img_hash in img_hashes:
+            for band in hash_bands(hash_to_int(img_hash), INTER_POST_THRESHOLD + 1):
+                band_to_images[band].append((post_id, img_hash))
+
+    pairs = set()
+    for bucket in band_to_images.values():
+        for i in range(len(bucket)):
+            post_id1, hash1 = bucket[i]
+            for j in range(i + 1, len(bucket)):
+                post_id2, hash2 = bucket[j]
+                if post_id1 == post_id2 or (min(post_id1, post_id2), max(post_id1, post_id2)) in pairs:
+                    continue
+                if abs(hash1 - hash2) <= INTER_POST_THRESHOLD:
+                    pairs.add((min(post_id1, post_id2), max(post_id1, post_id2)))
+    return pairs
+
+def cluster_posts(post_ids, pairs):
+    """
+    Groups posts connected by similarity pairs (transitively) with union-find.
+
+    Returns:
+        list: Sorted clusters (sorted lists of post ids) of 2 or more posts.
+    """
     # Union-Find Data Structure
     parent = {}
 
@@ -213,100 +211,208 @@ def deduplicate_across_posts():
             parent[pv] = pu
 
     # Initialize parent pointers
-    for post_id in posts:
+    for post_id in post_ids:
         parent[post_id] = post_id
 
-    # Build inverted index: hash -> set of post_ids
-    hash_to_posts = defaultdict(set)
-    for post_id, img_hashes in posts.items():
-        for img_hash in img_hashes:
-            hash_to_posts[img_hash].add(post_id)
-
     # Union posts that share similar images
-    for img_hash, post_ids in hash_to_posts.items():
-        post_ids = list(post_ids)
-        for i in range(len(post_ids)):
-            for j in range(i + 1, len(post_ids)):
-                post_id1 = post_ids[i]
-                post_id2 = post_ids[j]
-                if find(post_id1) != find(post_id2):
-                    union(post_id1, post_id2)
+    for post_id1, post_id2 in pairs:
+        union(post_id1, post_id2)
 
     # Group posts by their root parent
     clusters = defaultdict(set)
-    for post_id in posts:
+    for post_id in post_ids:
         root = find(post_id)
         clusters[root].add(post_id)
-
-    # Handle duplicates within clusters
+    return sorted(sorted(c) for c in clusters.values() if len(c) > 1)
+
+def count_duplicate_posts(clusters):
+    return sum(len(c) - 1 for c in clusters)
+
+def find_embedding_post_pairs(post_images):
+    from dedup_embeddings import compute_image_embeddings, find_similar_post_pairs_by_embeddings
+    img_paths, post_ids = [], []
+    for post_id, paths in sorted(post_images.items()):
+        img_paths.extend(sorted(paths))
+        post_ids.extend([post_id] * len(paths))
+    embeddings = compute_image_embeddings(img_paths, EMBEDDINGS_FILE, model_path=EMBEDDING_MODEL_PATH,
+                                          num_classes=EMBEDDING_MODEL_NUM_CLASSES, batch_size=EMBEDDING_BATCH_SIZE)
+    return find_similar_post_pairs_by_embeddings(embeddings, post_ids, EMBEDDING_COSINE_THRESHOLD)
+
+def find_text_post_pairs(posts):
+    post_texts = load_post_texts(INDEX_FILE)
+    post_texts = {post_id: text for post_id, text in post_texts.items() if post_id in posts}
+    return find_similar_post_pairs_by_text(post_texts, TEXT_JACCARD_THRESHOLD)
+
+def plan_across_posts_dedup(removed_paths):
+    print("Planning deduplication of images across posts...")
+    posts = defaultdict(set)
+    post_images = defaultdict(list)
+    for img_path, img_hash in all_hashes.items():
+        if img_path in removed_paths or not any([img_path.startswith(b) for b in BASE_IMAGES_DIRs]):
+            continue
+        post_id = get_post_id_from_path(img_path)
+        if post_id:
+            posts[post_id].add(img_hash)
+            post_images[post_id].append(img_path)
+
+    pairs = find_similar_post_pairs(posts)
+    extra_pair_sources = []
+    if EMBEDDING_DEDUP:
+        extra_pair_sources.append(('embedding', lambda: find_embedding_post_pairs(post_images)))
+    if TEXT_DEDUP:
+        extra_pair_sources.append(('text', lambda: find_text_post_pairs(posts)))
+    clusters, stats = merge_post_pairs(posts, pairs, extra_pair_sources)
+
+    post_sizes = {post_id: len(img_hashes) for post_id, img_hashes in posts.items()}
+    planned_clusters, actions = plan_cluster_moves(
+        clusters, post_sizes, ((post_id, p) for post_id, paths in post_images.items() for p in paths))
+    return planned_clusters, actions, stats
+
+def merge_post_pairs(post_ids, pairs, extra_pair_sources):
+    """
+    Clusters posts by pHash pairs, then adds pairs from extra_pair_sources (name, function returning pairs)
+    one by one into the same union-find, reporting how many duplicate posts each source adds on top.
+    """
+    clusters = cluster_posts(post_ids, pairs)
+    stats = {'phash_duplicate_posts': count_duplicate_posts(clusters)}
+    for source_name, find_pairs in extra_pair_sources:
+        duplicate_posts_before = count_duplicate_posts(clusters)
+        pairs |= find_pairs()
+        clusters = cluster_posts(post_ids, pairs)
+        stats[f'{source_name}_extra_duplicate_posts'] = count_duplicate_posts(clusters) - duplicate_posts_before
+        print(f"{source_name.capitalize()} similarity found {stats[f'{source_name}_extra_duplicate_posts']} "
+              f"extra duplicate posts.")
+    return clusters, stats
+
+def select_keepers(clusters, post_sizes, post_images):
+    if KEEPER_POLICY == 'most_images':
+        return most_images_keepers(clusters, post_sizes)
+    elif KEEPER_POLICY == 'quality':
+        post_dates = load_index_field(INDEX_FILE, 'date_ts') if os.path.exists(INDEX_FILE) else None
+        return quality_keepers(clusters, post_sizes, post_images, KEEPER_WEIGHTS, QUALITY_FILE, NUM_WORKERS,
+                               segmented_dir=SEGMENTED_DIR, post_dates=post_dates)
+    else:
+        raise ValueError(f"Unknown keeper policy '{KEEPER_POLICY}', expected one of: most_images, quality")
+
+def plan_cluster_moves(clusters, post_sizes, post_images):
+    """
+    Args:
+        clusters (list): Clusters of duplicate post ids.
+        post_sizes (dict): post_id -> number of distinct image hashes.
+        post_images (iterable): (post_id, image path) items, may be streamed from disk.
+    """
+    clustered_posts = {post_id for cluster in clusters for post_id in cluster}
+    clustered_post_images = defaultdict(list)
+    for post_id, img_path in post_images:
+        if post_id in clustered_posts:
+            clustered_post_images[post_id].append(img_path)
+
+    # Keep one post per cluster (see KEEPER_POLICY), the rest of the cluster goes to duplicates dir
+    keepers, scores = select_keepers(clusters, post_sizes, clustered_post_images)
+    planned_clusters = []
+    actions = []
     duplicate_id_counter = 0
-    for cluster_posts in clusters.values():
-        if len(cluster_posts) > 1:
-            # Collect images and counts
-            post_images = {}
-            for post_id in cluster_posts:
-                img_hashes = posts[post_id]
-                post_images[post_id] = img_hashes
-
-            # Sort posts by number of images (for case 5.3)
-            sorted_posts = sorted(post_images.items(), key=lambda x: len(x[1]), reverse=True)
-            original_post_id = sorted_posts[0][0]
-
-            # Handle according to the cases
-            for post_id in cluster_posts:
-                if post_id == original_post_id:
-                    # Move images to originals dir (if required)
-                    pass  # No action needed as per your updated requirements
-                else:
-                    # Move images to duplicates dir
-                    duplicate_id_counter += 1
-                    duplicate_id = f"dup{duplicate_id_counter:04d}"
-                    move_post_images_to_duplicates(post_id, duplicate_id)
-
-            print(f"Handled duplicate cluster: {cluster_posts} ({original_post_id} selected)")
-
-    print("Inter-post deduplication complete.")
-
-def move_post_images_to_duplicates(post_id, duplicate_id):
-    for img_path in list(all_hashes.keys()):
-        if get_post_id_from_path(img_path) == post_id:
-            current_path = progress['image_location_map'].get(img_path, img_path)
-            if os.path.exists(current_path):
-                new_filename = f"{duplicate_id}_{os.path.basename(current_path)}"
-                new_path = os.path.join(DUPLICATES_DIR, new_filename)
-                shutil.move(current_path, new_path)
-                progress['image_location_map'][img_path] = new_path  # Update mapping
-                del all_hashes[img_path]  # Remove from hashes
-            else:
-                print(f"File already moved or missing: {current_path}")
-
-def deduplication_loop():
-    # Load progress if any
-    load_progress()
-
-    # Compute or load image hashes
-    compute_image_hashes()
-
+    for cluster_posts_ids, original_post_id in zip(clusters, keepers):
+        duplicates = [p for p in cluster_posts_ids if p != original_post_id]
+        for post_id in duplicates:
+            duplicate_id_counter += 1
+            duplicate_id = f"dup{duplicate_id_counter:04d}"
+            for img_path in sorted(clustered_post_images[post_id]):
+                new_filename = f"{duplicate_id}_{os.path.basename(img_path)}"
+                actions.append({'op': 'move', 'src': img_path, 'dst': os.path.join(DUPLICATES_DIR, new_filename),
+                                'reason': 'cross_post'})
+        planned_cluster = {'keeper': original_post_id, 'duplicates': duplicates}
+        if scores:
+            planned_cluster['scores'] = {post_id: scores[post_id] for post_id in cluster_posts_ids}
+        planned_clusters.append(planned_cluster)
+
+    print(f"Inter-post deduplication planned: {len(planned_clusters)} clusters, {len(actions)} images to move.")
+    return planned_clusters, actions
+
+def plan_in_memory_dedup():
     global all_hashes
-    # Update hashes to only include existing files
-    all_hashes = {k: v for k, v in all_hashes.items() if os.path.exists(progress['image_location_map'].get(k, k))}
-
-    # Step 3: Deduplicate within posts
-    deduplicate_within_posts()
-
-    # Step 4: Remove special ads images
-    remove_special_ads_images()
-
-    # Update hashes after removals
-    all_hashes = {k: v for k, v in all_hashes.items() if os.path.exists(progress['image_location_map'].get(k, k))}
-
-    # Step 5: Deduplicate across posts
-    deduplicate_across_posts()
-
-    print("Deduplication process completed.")
+    compute_image_hashes()
+    # Cached hashes may reference files that were removed by a previously applied plan
+    all_hashes = {k: v for k, v in all_hashes.items() if os.path.exists(k)}
+
+    # Step 1: Deduplicate within posts
+    actions = plan_within_posts_dedup()
+
+    # Step 2: Remove special ads images
+    removed_paths = {a['src'] for a in actions}
+    for action in plan_special_ads_removal():
+        if action['src'] not in removed_paths:
+            actions.append(action)
+            removed_paths.add(action['src'])
+
+    # Step 3: Deduplicate across posts
+    clusters, cross_post_actions, stats = plan_across_posts_dedup(removed_paths)
+    return actions + cross_post_actions, clusters, stats
+
+def plan_sharded_dedup():
+    """
+    Same as plan_in_memory_dedup, but every BASE_IMAGES_DIRs entry is hashed and band-bucketed
+    by its own worker process, see dedup_shards.py. Embedding dedup needs all embeddings at once so it isn't
+    supported here.
+    """
+    from dedup_shards import (run_sharded_hashing, load_shards_posts, iter_shards_removed_images,
+                              iter_shards_post_images, iter_post_pairs)
+    if EMBEDDING_DEDUP:
+        raise ValueError("EMBEDDING_DEDUP is not supported in the SHARDED mode")
+
+    special_hashes = []
+    for special_dir in SPECIAL_ADS_DIRS:
+        for img_path in glob_images_in_directory(special_dir):
+            img_hash = compute_phash(img_path)
+            if img_hash is not None:
+                special_hashes.append(hash_to_int(img_hash))
+
+    print(f"Hashing and bucketing {len(BASE_IMAGES_DIRs)} shards with {NUM_WORKERS} workers...")
+    shard_names, pairs_paths = run_sharded_hashing(BASE_IMAGES_DIRs, SHARDS_DIR, special_hashes,
+                                                   INTRA_POST_THRESHOLD, INTER_POST_THRESHOLD, NUM_WORKERS,
+                                                   NUM_BAND_PARTITIONS)
+    actions = [removal_action(img_path, reason)
+               for img_path, reason in iter_shards_removed_images(shard_names, SHARDS_DIR)]
+    print(f"Intra-post and special ads deduplication planned: {len(actions)} images to remove.")
+
+    code_to_post_id, post_sizes = load_shards_posts(shard_names, SHARDS_DIR)
+    pairs = set(iter_post_pairs(pairs_paths, code_to_post_id))
+    extra_pair_sources = [('text', lambda: find_text_post_pairs(post_sizes))] if TEXT_DEDUP else []
+    clusters, stats = merge_post_pairs(post_sizes, pairs, extra_pair_sources)
+    planned_clusters, cross_post_actions = plan_cluster_moves(
+        clusters, post_sizes, iter_shards_post_images(shard_names, SHARDS_DIR, code_to_post_id))
+    return actions + cross_post_actions, planned_clusters, stats
+
+def deduplication_plan():
+    if SHARDED:
+        actions, clusters, stats = plan_sharded_dedup()
+    else:
+        actions, clusters, stats = plan_in_memory_dedup()
+
+    thresholds = {'intra_post': INTRA_POST_THRESHOLD, 'inter_post': INTER_POST_THRESHOLD}
+    if EMBEDDING_DEDUP:
+        thresholds['embedding_cosine'] = EMBEDDING_COSINE_THRESHOLD
+    if TEXT_DEDUP:
+        thresholds['text_jaccard'] = TEXT_JACCARD_THRESHOLD
+    plan = {
+        'thresholds': thresholds,
+        'stats': stats,
+        'clusters': clusters,
+        'actions': actions,
+    }
+    save_plan(plan, PLAN_FILE)
+    print("Deduplication plan completed.")
 
 def main():
-    deduplication_loop()
+    mode = sys.argv[1] if len(sys.argv) > 1 else MODE
+    if mode == 'plan':
+        deduplication_plan()
+    elif mode == 'apply':
+        apply_plan(load_plan(PLAN_FILE), JOURNAL_FILE)
+    elif mode == 'undo':
+        undo_plan(JOURNAL_FILE)
+    else:
+        raise ValueError(f"Unknown mode '{mode}', expected one of: plan, apply, undo")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,48 @@
+import time
+import numpy as np
+from torchreid.data.sampler import RandomIdentitySampler
+from identity_sampler import ArrayIdentitySampler
+
+#### Docs:
+# Epoch-start overhead of identity-balanced samplers on a synthetic train set: construction and the index list of one
+# epoch (what a DataLoader waits for before the first batch) of torchreid's RandomIdentitySampler and of
+# identity_sampler.ArrayIdentitySampler. Images per identity are geometric, as in posts: most have 2-5 images.
+
+# ----------------------- Configuration Parameters -----------------------
+
+num_pids = 60000
+mean_images_per_pid = 4
+batch_size = 32
+num_instances = 4
+num_epochs = 3
+seed = 0
+
+# ------------------------------------------------------------------------
+
+
+def synthetic_train_set():
+    rng = np.random.default_rng(seed)
+    pids = np.repeat(np.arange(num_pids), rng.geometric(1 / mean_images_per_pid, size=num_pids))
+    rng.shuffle(pids)
+    return [(f"{i}.jpg", int(pid), 0, 0) for i, pid in enumerate(pids)]
+
+
+def benchmark_sampler(name, build):
+    start = time.perf_counter()
+    sampler = build()
+    init_s = time.perf_counter() - start
+    epoch_s = []
+    for _ in range(num_epochs):
+        start = time.perf_counter()
+        indices = list(iter(sampler))
+        epoch_s.append(time.perf_counter() - start)
+    print(f"{name}: init {init_s * 1000:.0f} ms, epoch start {np.mean(epoch_s) * 1000:.0f} ms "
+          f"(mean of {num_epochs}), {len(indices)} samples per epoch")
+
+
+if __name__ == '__main__':
+
+    train = synthetic_train_set()
+    print(f"{num_pids} identities, {len(train)} images, batch_size={batch_size}, num_instances={num_instances}")
+    benchmark_sampler('RandomIdentitySampler', lambda: RandomIdentitySampler(train, batch_size, num_instances))
+    benchmark_sampler('ArrayIdentitySampler', lambda: ArrayIdentitySampler(train, batch_size, num_instances, seed))
@@ -0,0 +1,48 @@
+import time
+import torchreid
+from torch.utils.data import DataLoader
+from my_datasets.vkg34900407plus import Vkg34900407plus
+from my_datasets.image_cache import with_image_cache
+
+#### Docs:
+# Epoch time of the train loader with and without my_datasets.image_cache, with the training transforms of
+# train-reid.py, so the DataLoader cost (decoding + augmentation), not the model, is measured.
+# The first cached epoch decodes and fills the cache, the next ones only read it.
+
+# ----------------------- Configuration Parameters -----------------------
+
+dataset_class = Vkg34900407plus
+image_cache_dir = None  # None for the temp dir, '/dev/shm' on Linux to keep it in RAM
+transforms = ['random_flip', 'random_crop', 'random_erase']
+batch_size = 32
+num_workers = 4
+num_epochs = 3
+
+# ------------------------------------------------------------------------
+
+
+def epoch_times(dataset):
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                        persistent_workers=num_workers > 0, drop_last=True)
+    times = []
+    for _ in range(num_epochs):
+        start = time.perf_counter()
+        for _ in loader:
+            pass
+        times.append(time.perf_counter() - start)
+    return times
+
+
+if __name__ == '__main__':
+
+    transform_train, _ = torchreid.data.transforms.build_transforms(height=256, width=128, transforms=transforms)
+    results = {}
+    for name, cls in [('no cache', dataset_class), ('image cache', with_image_cache(dataset_class, image_cache_dir))]:
+        dataset = cls(root=dataset_class.base_path, transform=transform_train, mode='train', verbose=False)
+        results[name] = epoch_times(dataset)
+        print(f"{name}: epoch times {', '.join(f'{t:.1f} s' for t in results[name])} ({len(dataset)} images, "
+              f"{num_workers} workers)")
+
+    uncached = sum(results['no cache']) / num_epochs
+    cached = sum(results['image cache'][1:]) / max(1, num_epochs - 1)
+    print(f"Mean epoch: {uncached:.1f} s without cache, {cached:.1f} s with a filled cache ({uncached / cached:.1f}x)")
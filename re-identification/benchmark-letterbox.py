@@ -0,0 +1,97 @@
+import os
+import glob
+import time
+import tempfile
+import torch
+import torchreid
+from PIL import Image
+from torchreid.utils import read_image
+from prepare_dataset import materialise_image
+from letterbox import LETTERBOX_SIZE, IMAGENET_MEAN, IMAGENET_STD, load_image, letterbox_batch, normalize_batch, to_pil
+
+#### Docs:
+# 1. Speed of letterbox.letterbox_batch against the per-image PIL resize-and-paste it replaced in prepare_dataset.py,
+#    on decoded images, so decoding doesn't hide the difference
+# 2. Check that training and inference see the same inputs: for every sample image, the inference path
+#    (load_image + letterbox_batch + normalize_batch) against what training really reads: the JPEG that
+#    prepare_dataset.py writes, read back by torchreid's read_image and its test transform. JPEG saving is lossy, so
+#    they match up to its noise, a few levels on average; a geometry or colour mismatch (shifted letterbox, another
+#    resize, BGR) is far above that
+
+# ----------------------- Configuration Parameters -----------------------
+
+sample_directory = '/Users/albert.bikeev/Projects/sobaken-id/data/segmented/vk_posts/vkg34900407plus_DEDUP_enriched'
+sample_size = 500
+batch_size = 64
+tolerance = 3.0  # Max mean abs difference per image in 0-255 levels, JPEG noise at PIL's default quality is below
+
+# ------------------------------------------------------------------------
+
+
+def pil_pad_and_resize(img, target_size):
+    # The per-image baseline: a new PIL image per sample, target_size is (width, height)
+    img = img.copy()
+    img.thumbnail(target_size, Image.LANCZOS)
+    new_img = Image.new('RGB', target_size, (0, 0, 0))
+    new_img.paste(img, ((target_size[0] - img.width) // 2, (target_size[1] - img.height) // 2))
+    return new_img
+
+
+def benchmark_speed(image_paths):
+    height, width = LETTERBOX_SIZE
+    images = [load_image(path) for path in image_paths]
+    pil_images = [to_pil(image) for image in images]
+
+    start = time.perf_counter()
+    for img in pil_images:
+        pil_pad_and_resize(img, (width, height))
+    pil_ms = (time.perf_counter() - start) / len(pil_images) * 1000
+
+    start = time.perf_counter()
+    for i in range(0, len(images), batch_size):
+        letterbox_batch(images[i:i + batch_size])
+    batch_ms = (time.perf_counter() - start) / len(images) * 1000
+
+    print(f"PIL resize-and-paste: {pil_ms:.2f} ms/image, letterbox_batch of {batch_size}: {batch_ms:.2f} ms/image "
+          f"({pil_ms / batch_ms:.1f}x)")
+
+
+def check_train_inference_match(image_paths):
+    height, width = LETTERBOX_SIZE
+    _, transform_test = torchreid.data.transforms.build_transforms(
+        height=height, width=width, transforms=None, norm_mean=IMAGENET_MEAN, norm_std=IMAGENET_STD)
+    # Normalised differences back to 0-255 levels
+    levels = torch.tensor(IMAGENET_STD).view(1, 3, 1, 1) * 255
+
+    max_diff, mean_diffs, mismatches = 0.0, [], []
+    with tempfile.TemporaryDirectory() as prepared_dir:
+        for i in range(0, len(image_paths), batch_size):
+            paths = image_paths[i:i + batch_size]
+            inference = normalize_batch(letterbox_batch([load_image(path) for path in paths]))
+            training = []
+            for j, path in enumerate(paths):
+                # Written as prepare_dataset.py writes dataset images, read as torchreid's ImageDataset reads them
+                prepared_path = os.path.join(prepared_dir, f"{j}.jpg")
+                materialise_image((path, prepared_path, (width, height)))
+                training.append(transform_test(read_image(prepared_path)))
+            diffs = ((inference - torch.stack(training)).abs() * levels).flatten(1)
+            max_diff = max(max_diff, float(diffs.max()))
+            image_diffs = diffs.mean(dim=1).tolist()
+            mean_diffs += image_diffs
+            mismatches += [path for path, diff in zip(paths, image_diffs) if diff > tolerance]
+
+    print(f"Train/inference preprocessing on {len(image_paths)} images: mean abs difference "
+          f"{sum(mean_diffs) / max(1, len(mean_diffs)):.2f} levels (worst image {max(mean_diffs, default=0.0):.2f}), "
+          f"max {max_diff:.0f} levels, {len(mismatches)} images above {tolerance}")
+    for path in mismatches[:10]:
+        print(f"  Mismatch: {path}")
+    return not mismatches
+
+
+if __name__ == '__main__':
+
+    sample_paths = sorted(glob.glob(os.path.join(sample_directory, '*.jpg')))[:sample_size]
+    print(f"Letterbox benchmark on {len(sample_paths)} images.")
+    benchmark_speed(sample_paths)
+    if not check_train_inference_match(sample_paths):
+        raise SystemExit(1)
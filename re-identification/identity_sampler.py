@@ -0,0 +1,247 @@
+import os
+import copy
+import glob
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Sampler
+
+#### Docs:
+# Identity-balanced sampling as torchreid's RandomIdentitySampler (batches of batch_size // num_instances identities,
+# num_instances images each), without rebuilding dicts of lists of every pid at the start of every epoch.
+# Everything that doesn't depend on the shuffling is computed once, as arrays:
+# - dataset indices sorted by pid, with pid offsets (CSR), so shuffling within identities is one lexsort
+# - which shuffled positions make up chunks of num_instances images, identities with fewer images sample with
+#   replacement as in torchreid
+# An epoch orders chunks into rounds (the n-th chunk of every identity is in round n), shuffles identities within
+# a round and cuts it into batches, so identities of a batch are always distinct. The last partial batch of a round is
+# dropped, as torchreid drops identities left when fewer than a batch remain. Batches are shuffled across rounds.
+# HardNegativeIdentitySampler: same chunks and rounds, but a batch is a random identity and its nearest neighbour
+# identities (mutual neighbours first) by the current model, so triplet loss sees hard negatives instead of mostly easy
+# ones. Every refresh_every epochs the train set is embedded with the model being trained (cached on disk per epoch,
+# so a run resumed with start_epoch doesn't embed an epoch again, a fresh run clears it) and the neighbours are rebuilt:
+# exact k nearest neighbours of identity centroids by chunked matrix products, fast enough for tens of thousands of
+# identities without an ANN library.
+
+
+class ArrayIdentitySampler(Sampler):
+    def __init__(self, data_source, batch_size, num_instances, seed=None):
+        if batch_size < num_instances:
+            raise ValueError(f"batch_size={batch_size} must be no less than num_instances={num_instances}")
+        self.num_instances = num_instances
+        self.num_pids_per_batch = batch_size // num_instances
+        self.rng = np.random.default_rng(seed)
+
+        pids = np.array([item[1] for item in data_source])
+        self.indices = np.argsort(pids, kind='stable')
+        _, counts = np.unique(pids, return_counts=True)
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        self.segment_ids = np.repeat(np.arange(len(counts)), counts)
+
+        # Identities with enough images: the first (count // num_instances) * num_instances shuffled images
+        num_chunks = counts // num_instances
+        position = np.arange(len(pids)) - np.repeat(offsets, counts)
+        self.chunk_mask = position < np.repeat(num_chunks * num_instances, counts)
+        big = num_chunks > 0
+        self.num_segments = len(counts)
+        self.row_segments = np.empty(len(pids), dtype=np.int64)
+        self.row_segments[self.indices] = self.segment_ids
+        chunk_offsets = np.cumsum(num_chunks[big]) - num_chunks[big]
+        big_ranks = np.arange(num_chunks.sum()) - np.repeat(chunk_offsets, num_chunks[big])
+        # Identities with fewer images: num_instances images drawn with replacement, one chunk
+        self.small_offsets = offsets[~big]
+        self.small_counts = counts[~big]
+        self.ranks = np.concatenate([big_ranks, np.zeros(len(self.small_counts), dtype=np.int64)])
+        self.chunk_segments = np.concatenate([np.repeat(np.flatnonzero(big), num_chunks[big]), np.flatnonzero(~big)])
+
+        # Rounds are cut into whole batches, so the length doesn't depend on the shuffling
+        round_sizes = np.bincount(self.ranks)
+        self.round_starts = np.cumsum(round_sizes) - round_sizes
+        self.round_usable = round_sizes // self.num_pids_per_batch * self.num_pids_per_batch
+        self.length = int(self.round_usable.sum()) * num_instances
+
+    def epoch_chunks(self):
+        """
+        Returns:
+            np.ndarray: (num chunks, num_instances) dataset indices, chunk i is of identity chunk_segments[i].
+        """
+        shuffled = self.indices[np.lexsort((self.rng.random(len(self.indices)), self.segment_ids))]
+        small_chunks = self.small_offsets[:, None] + (
+            self.rng.random((len(self.small_counts), self.num_instances)) * self.small_counts[:, None]).astype(np.int64)
+        return np.concatenate([shuffled[self.chunk_mask].reshape(-1, self.num_instances), shuffled[small_chunks]])
+
+    def epoch_indices(self):
+        chunks = self.epoch_chunks()
+        order = np.lexsort((self.rng.random(len(chunks)), self.ranks))
+        ranks = self.ranks[order]
+        usable = np.arange(len(order)) - self.round_starts[ranks] < self.round_usable[ranks]
+        batches = chunks[order[usable]].reshape(-1, self.num_pids_per_batch * self.num_instances)
+        return batches[self.rng.permutation(len(batches))].ravel()
+
+    def __iter__(self):
+        return iter(self.epoch_indices().tolist())
+
+    def __len__(self):
+        return self.length
+
+
+class HardNegativeIdentitySampler(ArrayIdentitySampler):
+    def __init__(self, data_source, batch_size, num_instances, embed, refresh_every=5, num_neighbours=20,
+                 cache_dir=None, start_epoch=0, seed=None):
+        """
+        Args:
+            embed (callable): Returns L2-normalised embeddings (len(data_source), dim) of the train set by the model
+                being trained, in data_source order.
+            refresh_every (int): Epochs between embedding the train set, the neighbours are kept in between.
+            num_neighbours (int): Nearest identities kept per identity.
+            cache_dir (str): Dir of the embedding cache of this run, train_embeddings_<epoch>.npy, None to not cache.
+            start_epoch (int): Epoch of the first iteration when resuming, 0 starts a fresh run and clears the cache.
+        """
+        super(HardNegativeIdentitySampler, self).__init__(data_source, batch_size, num_instances, seed=seed)
+        self.embed = embed
+        self.refresh_every = refresh_every
+        self.num_neighbours = num_neighbours
+        self.cache_dir = cache_dir
+        self.epoch = start_epoch
+        self.neighbours = None
+        if cache_dir is not None and start_epoch == 0:
+            # Embeddings of a previous run are of another model
+            for cache_path in glob.glob(os.path.join(cache_dir, 'train_embeddings_*.npy')):
+                os.remove(cache_path)
+
+    def load_embeddings(self):
+        cache_path = os.path.join(self.cache_dir, f"train_embeddings_{self.epoch}.npy") if self.cache_dir else None
+        if cache_path is not None and os.path.exists(cache_path):
+            embeddings = np.load(cache_path)
+            if len(embeddings) == len(self.row_segments):
+                return embeddings
+        print(f"Embedding {len(self.row_segments)} train images for hard negative mining...")
+        embeddings = self.embed()
+        if cache_path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.save(cache_path, embeddings)
+        return embeddings
+
+    def group_by_neighbours(self, segments):
+        """
+        Args:
+            segments (np.ndarray): Identities of a round, each once.
+
+        Returns:
+            list: len(segments) // num_pids_per_batch arrays of positions in segments, a random identity and its
+            nearest free neighbours, topped up with random identities where neighbours run out.
+        """
+        position = np.full(self.num_segments, -1, dtype=np.int64)
+        position[segments] = np.arange(len(segments))
+        neighbour_positions = position[self.neighbours[segments]].tolist()
+        free = [True] * len(segments)
+        groups, leftover = [], []
+        for start in self.rng.permutation(len(segments)).tolist():
+            if not free[start]:
+                continue
+            group = [start]
+            free[start] = False
+            for neighbour in neighbour_positions[start]:
+                if len(group) == self.num_pids_per_batch:
+                    break
+                if neighbour >= 0 and free[neighbour]:
+                    group.append(neighbour)
+                    free[neighbour] = False
+            if len(group) == self.num_pids_per_batch:
+                groups.append(np.array(group))
+            else:
+                leftover += group
+        leftover = self.rng.permutation(leftover)
+        num_leftover_groups = len(leftover) // self.num_pids_per_batch
+        groups += list(leftover[:num_leftover_groups * self.num_pids_per_batch].reshape(
+            num_leftover_groups, self.num_pids_per_batch))
+        return groups
+
+    def epoch_indices(self):
+        if self.epoch % self.refresh_every == 0 or self.neighbours is None:
+            self.neighbours = identity_neighbours(self.load_embeddings(), self.row_segments, self.num_segments,
+                                                  self.num_neighbours)
+        self.epoch += 1
+
+        chunks = self.epoch_chunks()
+        batches = []
+        for rank in range(len(self.round_usable)):
+            round_chunks = np.flatnonzero(self.ranks == rank)
+            for group in self.group_by_neighbours(self.chunk_segments[round_chunks]):
+                batches.append(chunks[round_chunks[group]].ravel())
+        # No round may fill a batch on tiny train sets, as ArrayIdentitySampler yields nothing then
+        batches = np.stack(batches) if batches else np.empty((0, self.num_pids_per_batch * self.num_instances),
+                                                             dtype=np.int64)
+        return batches[self.rng.permutation(len(batches))].ravel()
+
+
+def identity_neighbours(embeddings, row_segments, num_segments, num_neighbours, chunk_size=512):
+    """
+    Args:
+        embeddings (np.ndarray): L2-normalised embeddings of the images.
+        row_segments (np.ndarray): Identity (0 .. num_segments - 1) of every image.
+
+    Returns:
+        np.ndarray: (num_segments, num_neighbours) nearest identities by cosine similarity of identity centroids,
+        mutual neighbours (each is among the other's nearest) first, then by similarity.
+    """
+    centroids = np.zeros((num_segments, embeddings.shape[1]), dtype=np.float32)
+    np.add.at(centroids, row_segments, embeddings)
+    centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    num_neighbours = min(num_neighbours, num_segments - 1)
+
+    neighbours = np.empty((num_segments, num_neighbours), dtype=np.int64)
+    for start in range(0, num_segments, chunk_size):
+        similarities = centroids[start:start + chunk_size] @ centroids.T
+        rows = np.arange(len(similarities))
+        similarities[rows, start + rows] = -np.inf
+        nearest = np.argpartition(similarities, -num_neighbours, axis=1)[:, -num_neighbours:]
+        nearest_order = np.argsort(-similarities[rows[:, None], nearest], axis=1)
+        neighbours[start:start + chunk_size] = np.take_along_axis(nearest, nearest_order, axis=1)
+
+    for start in range(0, num_segments, chunk_size):
+        rows = neighbours[start:start + chunk_size]
+        mutual = (neighbours[rows] == np.arange(start, start + len(rows))[:, None, None]).any(axis=2)
+        neighbours[start:start + chunk_size] = np.take_along_axis(rows, np.argsort(~mutual, axis=1, kind='stable'),
+                                                                  axis=1)
+    return neighbours
+
+
+def embed_images(model, dataset, batch_size=256, num_workers=4):
+    """
+    Returns:
+        np.ndarray: L2-normalised embeddings of the torchreid dataset in its order, the model is left in its mode.
+    """
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    device = next(model.parameters()).device
+    was_training = model.training
+    model.eval()
+    embeddings = []
+    with torch.no_grad():
+        for batch in loader:
+            features = model(batch['img'].to(device))
+            embeddings.append(torch.nn.functional.normalize(features, dim=1).cpu().numpy())
+    model.train(was_training)
+    return np.concatenate(embeddings)
+
+
+def use_identity_sampler(datamanager, batch_size, num_instances, seed=None, model=None, **hard_negative_kwargs):
+    """
+    Replaces the train loader of a torchreid ImageDataManager with one sampled by ArrayIdentitySampler, or with a model
+    by HardNegativeIdentitySampler (hard_negative_kwargs go to it), call before building the engine.
+    Use train_sampler='RandomSampler' in the data manager, so it doesn't build its own identity index for nothing.
+    """
+    loader = datamanager.train_loader
+    if model is None:
+        sampler = ArrayIdentitySampler(loader.dataset.train, batch_size, num_instances, seed=seed)
+    else:
+        # Embedded without augmentation
+        embed_dataset = copy.copy(loader.dataset)
+        embed_dataset.transform = datamanager.transform_te
+        sampler = HardNegativeIdentitySampler(
+            loader.dataset.train, batch_size, num_instances,
+            embed=lambda: embed_images(model, embed_dataset, num_workers=loader.num_workers), seed=seed,
+            **hard_negative_kwargs)
+    datamanager.train_loader = DataLoader(loader.dataset, sampler=sampler, batch_size=batch_size, shuffle=False,
+                                          num_workers=loader.num_workers, pin_memory=loader.pin_memory,
+                                          drop_last=True)
+    return sampler
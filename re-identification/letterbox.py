@@ -0,0 +1,97 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+#### Docs:
+# The one preprocessing of Re-ID images, shared by prepare_dataset.py, training and inference, so a query crop seen at
+# inference time goes through exactly what the training images went through:
+# 1. JPEG draft decode at 1/2, 1/4 or 1/8 scale while staying larger than the target size (load_image)
+# 2. Letterbox: downscale keeping the aspect ratio (never upscale), centre on black padding (letterbox_batch)
+# 3. ImageNet normalisation (normalize_batch)
+# Images are (3, H, W) uint8 tensors and letterboxing works on batches: images of the same size are resized with one
+# interpolate call, images already at the target size (e.g. outputs of prepare_dataset.py) are only copied.
+# Training reads prepare_dataset.py outputs, which are letterboxed already: torchreid's Resize((256, 128)) is a no-op
+# on them, so a plain ToTensor + Normalize there equals steps 1-3 here, up to the JPEG saving of the outputs.
+# benchmark-letterbox.py checks this on the saved JPEGs.
+
+LETTERBOX_SIZE = (256, 128)  # (height, width) of the model input
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+# Saved in the dataset manifest of prepare_dataset.py, change it when the preprocessing changes to rebuild datasets
+PREPROCESSING_VERSION = 'letterbox-bilinear-aa-1'
+
+
+def load_image(image_path, size=LETTERBOX_SIZE):
+    """
+    Returns:
+        torch.Tensor: (3, H, W) uint8 RGB, decoded at the smallest JPEG draft scale still larger than size.
+    """
+    img = Image.open(image_path)
+    img.draft('RGB', (size[1], size[0]))
+    return to_tensor(img.convert('RGB'))
+
+
+def to_tensor(img):
+    return torch.from_numpy(np.asarray(img, dtype=np.uint8).copy()).permute(2, 0, 1)
+
+
+def to_pil(image):
+    return Image.fromarray(image.permute(1, 2, 0).numpy())
+
+
+def letterbox_geometry(height, width, size=LETTERBOX_SIZE):
+    """
+    Returns:
+        tuple: (resized height, resized width, top, left) of an image of height x width in the letterbox.
+    """
+    target_height, target_width = size
+    scale = min(1.0, target_height / height, target_width / width)
+    new_height = min(target_height, max(1, round(height * scale)))
+    new_width = min(target_width, max(1, round(width * scale)))
+    return new_height, new_width, (target_height - new_height) // 2, (target_width - new_width) // 2
+
+
+def letterbox_batch(images, size=LETTERBOX_SIZE):
+    """
+    Args:
+        images (list): (3, H, W) uint8 tensors of any sizes.
+        size (tuple): (height, width) of the output.
+
+    Returns:
+        torch.Tensor: (N, 3, height, width) uint8 batch.
+    """
+    batch = torch.zeros((len(images), 3) + tuple(size), dtype=torch.uint8)
+    same_size = {}
+    for i, image in enumerate(images):
+        same_size.setdefault(tuple(image.shape[1:]), []).append(i)
+    for (height, width), indices in same_size.items():
+        new_height, new_width, top, left = letterbox_geometry(height, width, size)
+        group = torch.stack([images[i] for i in indices])
+        if (new_height, new_width) != (height, width):
+            group = F.interpolate(group.float(), size=(new_height, new_width), mode='bilinear', align_corners=False,
+                                  antialias=True).round_().clamp_(0, 255).to(torch.uint8)
+        batch[indices, :, top:top + new_height, left:left + new_width] = group
+    return batch
+
+
+def letterbox(image, size=LETTERBOX_SIZE):
+    return letterbox_batch([image], size)[0]
+
+
+def normalize_batch(batch):
+    """
+    Returns:
+        torch.Tensor: Float batch normalised as torchvision ToTensor + Normalize with ImageNet mean and std.
+    """
+    mean = torch.tensor(IMAGENET_MEAN, device=batch.device).view(1, 3, 1, 1)
+    std = torch.tensor(IMAGENET_STD, device=batch.device).view(1, 3, 1, 1)
+    return (batch.float() / 255 - mean) / std
+
+
+def letterbox_collate(samples):
+    """
+    collate_fn for DataLoaders of (uint8 image, path) samples of any sizes: letterboxes and normalises the batch.
+    """
+    images, paths = zip(*samples)
+    return normalize_batch(letterbox_batch(list(images))), list(paths)
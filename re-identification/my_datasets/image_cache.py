@@ -0,0 +1,114 @@
+import os
+import atexit
+import tempfile
+import numpy as np
+from PIL import Image
+from torchreid.utils import read_image
+
+#### Docs:
+# Opt-in cache of decoded images for our ImageDataset subclasses: prepared images are all 128x256, so a 60k image split
+# is ~5.6 GB of uint8 and DataLoader workers don't need to decode the same JPEGs every epoch.
+# - The cache is a memory mapped file (images, then filled flags) created by the dataset in the main process, in
+#   cache_dir (a tmpfs like /dev/shm on Linux keeps it in RAM, by default the temp dir: page cache, same effect
+#   while memory lasts). Workers reopen it by path, with fork and with spawn (macOS), so all workers and all epochs
+#   share one copy, filled by whichever worker decodes an image first. Files are sparse and removed at exit.
+# - Only decoding is cached: transforms (augmentations) are still applied on every __getitem__.
+# - Images of another size than image_size are decoded every time.
+# Use: with_image_cache(Vkg34900407plus), see train-reid.py and benchmark-image-cache.py.
+
+IMAGE_SIZE = (256, 128)  # (height, width) of prepare_dataset.py outputs
+
+
+class DecodedImageCache:
+    def __init__(self, num_images, image_size=IMAGE_SIZE, cache_dir=None):
+        cache_dir = cache_dir or tempfile.gettempdir()
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(prefix='reid_image_cache_', suffix='.u8', dir=cache_dir)
+        os.close(fd)
+        self.shape = (num_images,) + tuple(image_size) + (3,)
+        # Images first, then one flag byte per image, sparse until filled
+        os.truncate(self.path, int(np.prod(self.shape)) + num_images)
+        self.owner_pid = os.getpid()
+        self.open()
+        atexit.register(self.remove)
+
+    def open(self):
+        self.images = np.memmap(self.path, dtype=np.uint8, mode='r+', shape=self.shape)
+        self.filled = np.memmap(self.path, dtype=np.uint8, mode='r+', shape=(self.shape[0],),
+                                offset=int(np.prod(self.shape)))
+
+    def get(self, index):
+        if not self.filled[index]:
+            return None
+        return Image.fromarray(np.asarray(self.images[index]))
+
+    def put(self, index, img):
+        if img.size != (self.shape[2], self.shape[1]):
+            return
+        self.images[index] = np.asarray(img)
+        # Flag after the pixels, a reader never sees a half written image as filled
+        self.filled[index] = 1
+
+    def remove(self):
+        if os.getpid() == self.owner_pid and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getstate__(self):
+        # Workers reopen the same files instead of getting a copy of the arrays
+        state = self.__dict__.copy()
+        del state['images'], state['filled']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+
+class DecodedImageCacheMixin:
+    """
+    Caches decoded images of an ImageDataset subclass, put it first in the bases: class(DecodedImageCacheMixin, Dataset).
+    Datasets that don't read image files (PackedImageDataset) decode with their decode_image method.
+    """
+    image_cache_dir = None
+
+    def __init__(self, *args, **kwargs):
+        super(DecodedImageCacheMixin, self).__init__(*args, **kwargs)
+        self.image_cache = DecodedImageCache(len(self.data), cache_dir=self.image_cache_dir)
+
+    def __getitem__(self, index):
+        # Same as ImageDataset.__getitem__, decoding through the cache
+        img_path, pid, camid, dsetid = self.data[index]
+        img = self.image_cache.get(index)
+        if img is None:
+            img = self.decode_image(img_path) if hasattr(self, 'decode_image') else read_image(img_path)
+            self.image_cache.put(index, img)
+        if self.transform is not None:
+            img = self._transform_image(self.transform, self.k_tfm, img)
+        return {'img': img, 'pid': pid, 'camid': camid, 'impath': img_path, 'dsetid': dsetid}
+
+    def __reduce__(self):
+        # The class is made at run time by with_image_cache, workers started with spawn can't import it by name
+        state = self.__getstate__() if hasattr(self, '__getstate__') else self.__dict__
+        return restore_cached_dataset, (self.uncached_class, self.image_cache_dir, state)
+
+
+_cached_classes = {}
+
+
+def with_image_cache(dataset_class, cache_dir=None):
+    """
+    Returns:
+        type: Subclass of dataset_class with the same name and dataset_dir, caching decoded images in cache_dir.
+    """
+    key = (dataset_class, cache_dir)
+    if key not in _cached_classes:
+        _cached_classes[key] = type(dataset_class.__name__, (DecodedImageCacheMixin, dataset_class),
+                                    {'image_cache_dir': cache_dir, 'uncached_class': dataset_class})
+    return _cached_classes[key]
+
+
+def restore_cached_dataset(dataset_class, cache_dir, state):
+    cached_class = with_image_cache(dataset_class, cache_dir)
+    dataset = cached_class.__new__(cached_class)
+    dataset.__dict__.update(state)
+    return dataset
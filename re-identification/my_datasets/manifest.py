@@ -0,0 +1,103 @@
+import os
+import json
+
+#### Docs:
+# Dataset manifest shared by the datasets in my_datasets: the train/query/gallery dirs are walked once and every image
+# is saved to <dataset_dir>/manifest.json as [relative path, split, pid, camid, file size], so constructing a dataset
+# loads one file instead of globbing and parsing tens of thousands of filenames.
+# The manifest is rebuilt when a split dir, or dataset_manifest.json of prepare_dataset.py, is newer than it.
+# Files added by hand inside train/<pid>/ don't touch these mtimes: delete manifest.json (or pass rebuild=True).
+
+MANIFEST_FILE_NAME = 'manifest.json'
+SPLITS = ('train', 'query', 'gallery')
+
+
+def extract_pid(filename):
+    """
+    Extracts the person ID (pid) from the filename based on the new format:
+    'vkg<GROUP_ID>_<POST_ID>_<IMAGE_NUM>.jpg'
+
+    Args:
+        filename (str): The image filename.
+
+    Returns:
+        str: The combined pid as '<GROUP_ID>_<POST_ID>'.
+    """
+    basename, _ = os.path.splitext(filename)
+    if basename.startswith('vkg'):
+        basename = basename[3:]  # Remove 'vkg' prefix
+    parts = basename.split('_')
+    if len(parts) >= 3:
+        group_id = parts[0]
+        post_id = parts[1]
+        pid = f"{group_id}_{post_id}"
+        return pid
+    else:
+        print(f"Filename '{filename}' does not match the expected format.")
+        return None
+
+
+def scan_jpgs(dir_path, depth):
+    """
+    Yields os.DirEntry of *.jpg files directly in dir_path (depth 0) or in its subdirs (depth 1, train/<pid>/).
+    """
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if depth > 0 and entry.is_dir():
+                yield from scan_jpgs(entry.path, depth - 1)
+            elif depth == 0 and entry.name.endswith('.jpg') and entry.is_file():
+                yield entry
+
+
+def build_manifest(dataset_dir):
+    images = []
+    for split in SPLITS:
+        split_dir = os.path.join(dataset_dir, split)
+        # Single camera for training images, query and gallery are different cameras for torchreid evaluation
+        camid = 1 if split == 'gallery' else 0
+        for entry in scan_jpgs(split_dir, 1 if split == 'train' else 0):
+            pid = extract_pid(entry.name)
+            if pid is not None:
+                images.append([os.path.relpath(entry.path, dataset_dir), split, pid, camid, entry.stat().st_size])
+    images.sort()
+    with open(os.path.join(dataset_dir, MANIFEST_FILE_NAME), 'w', encoding='utf-8') as f:
+        json.dump({'images': images}, f)
+    return images
+
+
+def is_stale(dataset_dir, manifest_path):
+    manifest_mtime = os.path.getmtime(manifest_path)
+    sources = [os.path.join(dataset_dir, split) for split in SPLITS] + \
+              [os.path.join(dataset_dir, 'dataset_manifest.json')]
+    return any(os.path.exists(source) and os.path.getmtime(source) > manifest_mtime for source in sources)
+
+
+def load_manifest(dataset_dir, rebuild=False):
+    """
+    Returns:
+        list: [relative path, split, pid, camid, file size] of every image, built and cached on first use.
+    """
+    manifest_path = os.path.join(dataset_dir, MANIFEST_FILE_NAME)
+    if rebuild or not os.path.exists(manifest_path) or is_stale(dataset_dir, manifest_path):
+        return build_manifest(dataset_dir)
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)['images']
+
+
+def load_splits(dataset_dir, rebuild=False):
+    """
+    Returns:
+        tuple: (train, query, gallery) lists of (img_path, pid_label, camid). Train pids are relabelled to consecutive
+        labels, query and gallery share their own mapping, so the same identity has the same label in both.
+    """
+    images = load_manifest(dataset_dir, rebuild=rebuild)
+    train_pid2label = {pid: label for label, pid in
+                       enumerate(sorted({pid for _, split, pid, _, _ in images if split == 'train'}))}
+    test_pid2label = {pid: label for label, pid in
+                      enumerate(sorted({pid for _, split, pid, _, _ in images if split != 'train'}))}
+
+    splits = {split: [] for split in SPLITS}
+    for rel_path, split, pid, camid, _ in images:
+        pid2label = train_pid2label if split == 'train' else test_pid2label
+        splits[split].append((os.path.join(dataset_dir, rel_path), pid2label[pid], camid))
+    return splits['train'], splits['query'], splits['gallery']
@@ -0,0 +1,137 @@
+import io
+import os
+import json
+import random
+import tarfile
+from PIL import Image
+from torch.utils.data import IterableDataset, get_worker_info
+from torchreid.data.datasets import ImageDataset
+
+#### Docs:
+# Datasets packed by prepare_dataset.pack_dataset into <dataset_dir>/shards/*.tar + shards/index.json, so training
+# reads a few large files instead of tens of thousands of tiny JPEGs on network storage.
+# - PackedImageDataset: torchreid ImageDataset, works with ImageDataManager and its samplers (RandomIdentitySampler
+#   needs random access): every image is one seek + read in an already open shard, no per-image open/stat.
+#   Use it as the only source: ImageDataManager combines several sources into a plain ImageDataset
+# - PackedShuffleBufferDataset: IterableDataset for plain DataLoader training (e.g. softmax loss): every worker streams
+#   its own shards sequentially and shuffles through a buffer, pure sequential I/O
+
+
+def load_index(dataset_dir):
+    with open(os.path.join(dataset_dir, 'shards', 'index.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)['images']
+
+
+def relabel(index):
+    """
+    Returns:
+        tuple: (train pid -> label, query/gallery pid -> label), same labelling as manifest.load_splits.
+    """
+    train_pids = sorted({pid for _, split, pid, _, _, _, _ in index if split == 'train'})
+    test_pids = sorted({pid for _, split, pid, _, _, _, _ in index if split != 'train'})
+    return {pid: label for label, pid in enumerate(train_pids)}, {pid: label for label, pid in enumerate(test_pids)}
+
+
+class PackedImageDataset(ImageDataset):
+    dataset_dir = ''
+
+    def __init__(self, root='', **kwargs):
+        self.dataset_dir = os.path.join(root, self.dataset_dir)
+        self.shards_dir = os.path.join(self.dataset_dir, 'shards')
+        self.check_before_run([self.shards_dir])
+
+        index = load_index(self.dataset_dir)
+        train_pid2label, test_pid2label = relabel(index)
+        # img_path is '<shard>:<offset>:<size>', resolved by decode_image
+        splits = {'train': [], 'query': [], 'gallery': []}
+        for _, split, pid, camid, shard_name, offset, size in index:
+            pid2label = train_pid2label if split == 'train' else test_pid2label
+            splits[split].append((f"{shard_name}:{offset}:{size}", pid2label[pid], camid))
+        self.num_train_pids = len(train_pid2label)
+        # Shard file handles of the current process, DataLoader workers open their own
+        self._shards = {}
+        self._shards_pid = None
+
+        super(PackedImageDataset, self).__init__(splits['train'], splits['query'], splits['gallery'], **kwargs)
+
+    def decode_image(self, img_path):
+        if self._shards_pid != os.getpid():
+            self._shards, self._shards_pid = {}, os.getpid()
+        shard_name, offset, size = img_path.rsplit(':', 2)
+        shard = self._shards.get(shard_name)
+        if shard is None:
+            shard = self._shards[shard_name] = open(os.path.join(self.shards_dir, shard_name), 'rb')
+        shard.seek(int(offset))
+        return Image.open(io.BytesIO(shard.read(int(size)))).convert('RGB')
+
+    def __getitem__(self, index):
+        # Same as ImageDataset.__getitem__, reading from a shard instead of a file
+        img_path, pid, camid, dsetid = self.data[index]
+        img = self.decode_image(img_path)
+        if self.transform is not None:
+            img = self._transform_image(self.transform, self.k_tfm, img)
+        return {'img': img, 'pid': pid, 'camid': camid, 'impath': img_path, 'dsetid': dsetid}
+
+    def __getstate__(self):
+        # Open files can't be sent to worker processes
+        state = self.__dict__.copy()
+        state['_shards'], state['_shards_pid'] = {}, None
+        return state
+
+
+class PackedShuffleBufferDataset(IterableDataset):
+    def __init__(self, dataset_dir, split='train', transform=None, buffer_size=2048, seed=0):
+        index = load_index(dataset_dir)
+        train_pid2label, test_pid2label = relabel(index)
+        self.pid2label = train_pid2label if split == 'train' else test_pid2label
+        self.labels = {rel_path: (pid, camid) for rel_path, image_split, pid, camid, _, _, _ in index
+                       if image_split == split}
+        self.shard_paths = sorted({os.path.join(dataset_dir, 'shards', shard_name)
+                                   for _, image_split, _, _, shard_name, _, _ in index if image_split == split})
+        self.num_pids = len(self.pid2label)
+        self.transform = transform
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        # Different shard order and shuffling every epoch, call before iterating
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.labels)
+
+    def iter_samples(self, shard_paths):
+        for shard_path in shard_paths:
+            with tarfile.open(shard_path, 'r|') as tar:  # Streaming mode, strictly sequential reads
+                for member in tar:
+                    if member.name not in self.labels:
+                        continue
+                    pid, camid = self.labels[member.name]
+                    img = Image.open(io.BytesIO(tar.extractfile(member).read())).convert('RGB')
+                    if self.transform is not None:
+                        img = self.transform(img)
+                    yield {'img': img, 'pid': self.pid2label[pid], 'camid': camid, 'impath': member.name}
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        rng = random.Random(self.seed + self.epoch * 1000 + worker_id)
+        shard_paths = self.shard_paths[:]
+        random.Random(self.seed + self.epoch).shuffle(shard_paths)
+        # Every worker streams its own shards
+        buffer = []
+        for sample in self.iter_samples(shard_paths[worker_id::num_workers]):
+            if len(buffer) < self.buffer_size:
+                buffer.append(sample)
+                continue
+            ind = rng.randrange(len(buffer))
+            yield buffer[ind]
+            buffer[ind] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+class PackedVkg34900407plus(PackedImageDataset):
+    dataset_dir = 'Vkg34900407plus'
+    name = 'PackedVkg34900407plus'
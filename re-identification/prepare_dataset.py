@@ -1,24 +1,66 @@
 import os
 import glob
-import shutil
+import json
 import random
+import hashlib
+import tarfile
+import multiprocessing
 from tqdm import tqdm
-from PIL import Image
+from my_datasets.manifest import load_manifest
+from letterbox import PREPROCESSING_VERSION, load_image, letterbox, to_pil
 
 input_directory = '/Users/albert.bikeev/Projects/sobaken-id/data/segmented/vk_posts/vkg34900407plus_DEDUP_enriched'
 output_directory = '/Users/albert.bikeev/Projects/sobaken-id/data/clean/vkg34900407plus_DEDUP_enriched1'
 
 train_percent = 0.8
-random.seed(43)
+split_seed = 43
 
+# How test identities are chosen:
+# - 'hash': by a hash of the pid (and split_seed), so new posts land in train or test without moving existing ones,
+#   query images are chosen by a hash of the file name the same way
+# - 'random': random identities, any new post reshuffles the whole split
+# - 'time': the latest posts by date_ts from index_file, evaluates on posts newer than everything trained on
+# - 'group': identities of held_out_groups (or of random groups if empty), evaluates on unseen groups
+split_strategy = 'hash'
+queries_per_pid = 1  # Query images per test identity, at least one image is always left for the gallery
+index_file = None  # Posts index (JSON lines with group_id, post_id, date_ts), needed for the 'time' split
+held_out_groups = []  # Group ids (without the minus) for the 'group' split
+identities_file_name = 'identities.json'  # Cache of the input scan in the output dir
 
-def process_dataset(input_dir, output_dir, target_size=(128, 256)):
-    # Collect all image paths
-    image_paths = glob.glob(os.path.join(input_dir, '*.jpg'))
+num_workers = os.cpu_count()  # Processes decoding, resizing and saving images
+chunk_size = 64  # Images per task sent to a worker
+# What is on disk: output path -> input it was built from, see build_from_manifest
+manifest_file_name = 'dataset_manifest.json'
+# Builds before the manifest only recorded their target size here, it is migrated into the manifest and removed
+legacy_params_file_name = 'dataset_params.json'
+LEGACY_PREPROCESSING_VERSION = 'pil-lanczos-thumbnail'  # What those builds did, see migrate_params_file
 
-    # Build a mapping from post-id to list of images
-    post_id_to_images = {}
-    for image_path in image_paths:
+# Also pack the splits into large tar shards for training from network storage, see my_datasets/packed.py
+pack_shards = False
+shard_max_images = 20000  # ~200 MB of 128x256 JPEGs per shard
+
+
+def scan_identities(input_dir, output_dir, posts_index_file=None):
+    """
+    Scans the input dir once and caches the result in the output dir until the input dir or the index changes.
+
+    Returns:
+        dict: pid -> {'images': sorted image paths, 'group': group id, 'date': date_ts or None}, in pid order of
+        the sorted image paths.
+    """
+    cache_path = os.path.join(output_dir, identities_file_name)
+    key = {'input_dir': input_dir, 'input_mtime': os.path.getmtime(input_dir), 'index_file': posts_index_file,
+           'index_mtime': os.path.getmtime(posts_index_file) if posts_index_file else None}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached['key'] == key:
+            return cached['identities']
+
+    post_dates = load_post_dates(posts_index_file) if posts_index_file else {}
+    identities = {}
+    # Sorted so the split depends on the seed only, not on the file system order
+    for image_path in sorted(glob.glob(os.path.join(input_dir, '*.jpg'))):
         filename = os.path.basename(image_path)
         base_name, ext = os.path.splitext(filename)
         if '_' in base_name:
@@ -28,105 +70,307 @@ def process_dataset(input_dir, output_dir, target_size=(128, 256)):
             print(f"Skipping file with unexpected format: {filename}")
             continue
 
-        if unique_post_id not in post_id_to_images:
-            post_id_to_images[unique_post_id] = []
-        post_id_to_images[unique_post_id].append(image_path)
+        if unique_post_id not in identities:
+            # Animals of multi-animal posts are '<POST_ID>-<ANIMAL>', the date is the post's
+            identities[unique_post_id] = {'images': [], 'group': group_id[3:],
+                                          'date': post_dates.get(f"{group_id}_{post_id.split('-')[0]}")}
+        identities[unique_post_id]['images'].append(image_path)
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(cache_path, 'w', encoding='utf-8') as f:
+        json.dump({'key': key, 'identities': identities}, f)
+    return identities
+
+
+def load_post_dates(posts_index_file):
+    post_dates = {}
+    with open(posts_index_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                post = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping invalid JSON line: {line}")
+                continue
+            group_id = str(post.get('group_id')).replace('-', '')
+            post_id = str(post.get('post_id')).replace('-', '')
+            if post.get('date_ts') is not None:
+                post_dates[f"vkg{group_id}_{post_id}"] = post['date_ts']
+    return post_dates
+
+
+def stable_fraction(key, seed=split_seed):
+    """
+    Returns:
+        float: Position of key in [0, 1), uniformly spread and the same across runs, machines and dataset growth.
+    """
+    digest = hashlib.sha1(f"{seed}:{key}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+
+def split_identities(identities, strategy, rng, seed=split_seed):
+    """
+    Returns:
+        tuple: (train pids, test pids)
+    """
+    post_ids = list(identities.keys())
+    num_train = int(len(post_ids) * train_percent)
+    if strategy == 'hash':
+        train_ids = [pid for pid in post_ids if stable_fraction(pid, seed) < train_percent]
+        train_set = set(train_ids)
+        return train_ids, [pid for pid in post_ids if pid not in train_set]
+    elif strategy == 'random':
+        rng.shuffle(post_ids)
+        return post_ids[:num_train], post_ids[num_train:]
+    elif strategy == 'time':
+        undated = [pid for pid in post_ids if identities[pid]['date'] is None]
+        if undated:
+            print(f"{len(undated)} identities have no date in the index, they go to train.")
+        # Stable sort keeps the sorted path order for equal dates
+        post_ids.sort(key=lambda pid: identities[pid]['date'] if identities[pid]['date'] is not None else -1)
+        return post_ids[:num_train], post_ids[num_train:]
+    elif strategy == 'group':
+        test_groups = set(held_out_groups)
+        if not test_groups:
+            # Random groups until the test share is reached
+            groups = sorted({identity['group'] for identity in identities.values()})
+            rng.shuffle(groups)
+            num_test = 0
+            for group in groups:
+                if num_test >= len(post_ids) - num_train:
+                    break
+                test_groups.add(group)
+                num_test += sum(identity['group'] == group for identity in identities.values())
+        print(f"Held-out groups: {sorted(test_groups)}")
+        return ([pid for pid in post_ids if identities[pid]['group'] not in test_groups],
+                [pid for pid in post_ids if identities[pid]['group'] in test_groups])
+    raise ValueError(f"Unknown split strategy: {strategy}")
+
+
+def process_dataset(input_dir, output_dir, target_size=(128, 256), seed=split_seed, strategy=split_strategy,
+                    num_queries=queries_per_pid):
+    rng = random.Random(seed)
+    identities = scan_identities(input_dir, output_dir, index_file)
 
     # Filter out post-ids with only one image
-    filtered_post_ids = {pid: imgs for pid, imgs in post_id_to_images.items() if len(imgs) > 1}
+    filtered_post_ids = {pid: identity for pid, identity in identities.items() if len(identity['images']) > 1}
 
     print(f"Total identities with more than one image: {len(filtered_post_ids)}")
 
     # Split post-ids into train and test sets
-    post_ids = list(filtered_post_ids.keys())
-    random.shuffle(post_ids)
-    num_train = int(len(post_ids) * train_percent)  # 70% for training
-    train_ids = post_ids[:num_train]
-    test_ids = post_ids[num_train:]
+    train_ids, test_ids = split_identities(filtered_post_ids, strategy, rng, seed)
 
-    print(f"Training identities: {len(train_ids)}, Testing identities: {len(test_ids)}")
+    print(f"Split '{strategy}': training identities: {len(train_ids)}, testing identities: {len(test_ids)}")
 
     # Prepare output directories
     train_dir = os.path.join(output_dir, 'train')
     query_dir = os.path.join(output_dir, 'query')
     gallery_dir = os.path.join(output_dir, 'gallery')
 
-    # Remove existing directories if they exist to avoid mixing old data
-    if os.path.exists(train_dir):
-        shutil.rmtree(train_dir)
-    if os.path.exists(query_dir):
-        shutil.rmtree(query_dir)
-    if os.path.exists(gallery_dir):
-        shutil.rmtree(gallery_dir)
-
-    os.makedirs(train_dir, exist_ok=True)
-    os.makedirs(query_dir, exist_ok=True)
-    os.makedirs(gallery_dir, exist_ok=True)
-
-    # Process training identities
-    for pid in tqdm(train_ids, desc='Processing training identities'):
-        img_paths = filtered_post_ids[pid]
+    # Only the split is decided here, images are processed in parallel afterwards: (input path, output path) jobs
+    jobs = []
+
+    # Training identities
+    for pid in train_ids:
+        img_paths = filtered_post_ids[pid]['images']
         pid_dir = os.path.join(train_dir, pid)
-        os.makedirs(pid_dir, exist_ok=True)
         for img_path in img_paths:
-            img = process_image(img_path, target_size)
-            filename = clean_file_name(img_path)
-            img.save(os.path.join(pid_dir, filename))
-
-    # Process testing identities
-    for pid in tqdm(test_ids, desc='Processing testing identities'):
-        img_paths = filtered_post_ids[pid]
-        if len(img_paths) < 2:
-            print(f"Not enough images for identity {pid} to split into query and gallery.")
-            continue
-        random.shuffle(img_paths)
-        query_img_path = img_paths[0]
-        gallery_img_paths = img_paths[1:]
-
-        # Ensure gallery_img_paths is not empty TODO rm
-        if not gallery_img_paths:
-            print(f"No gallery images for identity {pid}. Moving image from query to gallery.")
-            gallery_img_paths.append(query_img_path)
-            query_img_path = gallery_img_paths.pop(0)
-            # If still empty, skip the identity
-            if not gallery_img_paths:
-                print(f"Still no gallery images for identity {pid}. Skipping identity.")
-                continue
+            jobs.append((img_path, os.path.join(pid_dir, clean_file_name(img_path))))
+
+    # Testing identities
+    for pid in test_ids:
+        img_paths = filtered_post_ids[pid]['images'][:]
+        if strategy == 'hash':
+            # New images of a post don't change which of its old images are queries unless they rank first
+            img_paths.sort(key=lambda img_path: stable_fraction(os.path.basename(img_path), seed))
+        else:
+            rng.shuffle(img_paths)
+        # Up to num_queries queries, the rest (at least one image, identities have two or more) is the gallery
+        num_pid_queries = min(num_queries, len(img_paths) - 1)
+        query_img_paths = img_paths[:num_pid_queries]
+        gallery_img_paths = img_paths[num_pid_queries:]
 
-        # Process query image
-        img = process_image(query_img_path, target_size)
-        img.save(os.path.join(query_dir, clean_file_name(query_img_path)))
+        # Query images
+        for img_path in query_img_paths:
+            jobs.append((img_path, os.path.join(query_dir, clean_file_name(img_path))))
 
-        # Process gallery images
+        # Gallery images
         for img_path in gallery_img_paths:
-            img = process_image(img_path, target_size)
-            img.save(os.path.join(gallery_dir, clean_file_name(img_path)))
+            jobs.append((img_path, os.path.join(gallery_dir, clean_file_name(img_path))))
 
+    build_from_manifest(jobs, output_dir, [train_dir, query_dir, gallery_dir], target_size)
     print("Dataset processing complete.")
 
+
+def source_state(src, target_size):
+    stat = os.stat(src)
+    return [src, stat.st_mtime_ns, stat.st_size, list(target_size), PREPROCESSING_VERSION]
+
+
+def build_from_manifest(jobs, output_dir, split_dirs, target_size):
+    """
+    Brings the split dirs to the desired state given by jobs (input path, output path) with as little work as possible:
+    the manifest of the previous build tells which input (path, mtime, size), target size and preprocessing version
+    every output was built from, so outputs of unchanged inputs are kept or moved (renamed, e.g. from gallery to query when the split
+    changes), outputs no longer wanted are removed and only new or changed inputs are processed.
+    """
+    manifest_path = os.path.join(output_dir, manifest_file_name)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    elif os.path.exists(os.path.join(output_dir, legacy_params_file_name)):
+        manifest = migrate_params_file(jobs, output_dir)
+
+    desired = {os.path.relpath(dst, output_dir): source_state(src, target_size) for src, dst in jobs}
+    # Outputs on disk that are up to date, by the state of the input they were built from
+    built = {}
+    for rel_path, state in manifest.items():
+        if os.path.exists(os.path.join(output_dir, rel_path)) and os.path.exists(state[0]) \
+                and source_state(state[0], target_size) == state:
+            built.setdefault(tuple(state[:3]), []).append(rel_path)
+
+    new_manifest, to_move, to_process = {}, [], []
+    for rel_path, state in desired.items():
+        if manifest.get(rel_path) == state and rel_path in built.get(tuple(state[:3]), []):
+            new_manifest[rel_path] = state
+            built[tuple(state[:3])].remove(rel_path)
+    for rel_path, state in desired.items():
+        if rel_path in new_manifest:
+            continue
+        candidates = built.get(tuple(state[:3]))
+        if candidates:
+            to_move.append((candidates.pop(), rel_path))
+        else:
+            to_process.append((state[0], rel_path))
+
+    # Everything in the split dirs that isn't kept or moved is removed, including files of interrupted builds
+    keep = set(new_manifest) | {old for old, _ in to_move}
+    removed = 0
+    for split_dir in split_dirs:
+        # *.jpg.movingN are left by a build interrupted between the two rename steps below
+        old_paths = glob.glob(os.path.join(split_dir, '**', '*.jpg'), recursive=True) + \
+            glob.glob(os.path.join(split_dir, '**', '*.jpg.moving*'), recursive=True)
+        for old_path in old_paths:
+            if os.path.relpath(old_path, output_dir) not in keep:
+                os.remove(old_path)
+                removed += 1
+    print(f"Images: {len(new_manifest)} unchanged, {len(to_move)} to move, {len(to_process)} to process, "
+          f"{removed} removed.")
+
+    # Two steps, so moves that swap or chain paths don't overwrite each other
+    for i, (old, _) in enumerate(to_move):
+        os.replace(os.path.join(output_dir, old), os.path.join(output_dir, f"{old}.moving{i}"))
+    for i, (old, new) in enumerate(to_move):
+        os.makedirs(os.path.dirname(os.path.join(output_dir, new)), exist_ok=True)
+        os.replace(os.path.join(output_dir, f"{old}.moving{i}"), os.path.join(output_dir, new))
+        new_manifest[new] = desired[new]
+
+    for dst_dir in {os.path.dirname(os.path.join(output_dir, rel_path)) for _, rel_path in to_process}:
+        os.makedirs(dst_dir, exist_ok=True)
+    with multiprocessing.Pool(num_workers) as pool:
+        tasks = [(src, os.path.join(output_dir, rel_path), target_size) for src, rel_path in to_process]
+        for _ in tqdm(pool.imap_unordered(materialise_image, tasks, chunksize=chunk_size),
+                      total=len(tasks), desc='Processing images'):
+            pass
+    new_manifest.update({rel_path: desired[rel_path] for _, rel_path in to_process})
+
+    for split_dir in split_dirs:
+        remove_empty_dirs(split_dir)
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(new_manifest, f)
+    # Only once the manifest is written, a crash before leaves the params file to migrate again
+    if os.path.exists(os.path.join(output_dir, legacy_params_file_name)):
+        os.remove(os.path.join(output_dir, legacy_params_file_name))
+
+
+def migrate_params_file(jobs, output_dir):
+    """
+    Builds the manifest of a dataset built before the manifest existed, when an output at the path of a job was up to
+    date if it was newer than its input and dataset_params.json had the same target size. Those outputs were resized
+    with PIL (LANCZOS thumbnail and paste), so they are recorded with LEGACY_PREPROCESSING_VERSION and
+    build_from_manifest keeps them only while PREPROCESSING_VERSION is the same: a letterbox build processes them again.
+
+    Returns:
+        dict: Manifest of the outputs, in the format of build_from_manifest.
+    """
+    with open(os.path.join(output_dir, legacy_params_file_name), 'r', encoding='utf-8') as f:
+        legacy_target_size = json.load(f)['target_size']
+    manifest = {}
+    for src, dst in jobs:
+        if os.path.exists(dst) and os.path.exists(src) and os.path.getmtime(dst) >= os.path.getmtime(src):
+            stat = os.stat(src)
+            manifest[os.path.relpath(dst, output_dir)] = [src, stat.st_mtime_ns, stat.st_size, legacy_target_size,
+                                                          LEGACY_PREPROCESSING_VERSION]
+    print(f"Migrated {len(manifest)} outputs of {legacy_params_file_name} into the manifest "
+          f"(preprocessing '{LEGACY_PREPROCESSING_VERSION}', current '{PREPROCESSING_VERSION}').")
+    return manifest
+
+
+def remove_empty_dirs(root_dir):
+    for dir_path, _, _ in sorted(os.walk(root_dir), key=lambda walked: -len(walked[0])):
+        if dir_path != root_dir and not os.listdir(dir_path):
+            os.rmdir(dir_path)
+
+
+def materialise_image(task):
+    src, dst, target_size = task
+    img = process_image(src, target_size)
+    img.save(dst)
+
 def clean_file_name(img_path):
     filename = os.path.basename(img_path)
     return str(filename.replace('_segmented', ''))
 
 def process_image(image_path, target_size):
-    # Load image
-    img = Image.open(image_path).convert('RGB')
+    # Same letterbox as at inference time, target_size is (width, height) as in PIL
+    size = (target_size[1], target_size[0])
+    return to_pil(letterbox(load_image(image_path, size), size))
+
+def pack_dataset(output_dir, max_images=shard_max_images, seed=split_seed):
+    """
+    Packs the built train/query/gallery images into <output_dir>/shards/<split>-<NNNNN>.tar (plain tar, images are
+    JPEGs already) and writes shards/index.json: [relative path, split, pid, camid, shard, data offset, size] per image,
+    so readers can both stream shards sequentially and read any image with one seek.
+    Train images are shuffled across identities, so sequential reading is already mixed.
+    """
+    shards_dir = os.path.join(output_dir, 'shards')
+    os.makedirs(shards_dir, exist_ok=True)
+    for old_shard in glob.glob(os.path.join(shards_dir, '*.tar')):
+        os.remove(old_shard)
 
-    # Resize and pad image to target size
-    img = pad_and_resize(img, target_size)
+    images = load_manifest(output_dir, rebuild=True)
+    rng = random.Random(seed)
+    index = []
+    for split in ('train', 'query', 'gallery'):
+        split_images = [image for image in images if image[1] == split]
+        if split == 'train':
+            rng.shuffle(split_images)
+        for shard_ind, start in enumerate(range(0, len(split_images), max_images)):
+            shard_name = f"{split}-{shard_ind:05d}.tar"
+            shard_path = os.path.join(shards_dir, shard_name)
+            shard_images = {rel_path: (split, pid, camid)
+                            for rel_path, _, pid, camid, _ in split_images[start:start + max_images]}
+            with tarfile.open(shard_path, 'w') as tar:
+                for rel_path in tqdm(shard_images, desc=f"Packing {shard_name}"):
+                    tar.add(os.path.join(output_dir, rel_path), arcname=rel_path)
+            # Data offsets are known once the headers are written, reading them back is a header-only scan
+            with tarfile.open(shard_path, 'r') as tar:
+                for member in tar:
+                    index.append([member.name, *shard_images[member.name], shard_name, member.offset_data,
+                                  member.size])
 
-    return img
+    index_path = os.path.join(shards_dir, 'index.json')
+    with open(f"{index_path}.tmp", 'w', encoding='utf-8') as f:
+        json.dump({'images': index}, f)
+    os.replace(f"{index_path}.tmp", index_path)
+    print(f"Packed {len(index)} images into {len(glob.glob(os.path.join(shards_dir, '*.tar')))} shards.")
 
-def pad_and_resize(img, target_size):
-    # Resize image while maintaining aspect ratio
-    img.thumbnail(target_size, Image.ANTIALIAS)
-    # Create a new image with the target size and paste the resized image onto it
-    new_img = Image.new('RGB', target_size, (0, 0, 0))
-    left = (target_size[0] - img.width) // 2
-    top = (target_size[1] - img.height) // 2
-    new_img.paste(img, (left, top))
-    return new_img
 
 if __name__ == '__main__':
 
     process_dataset(input_directory, output_directory, target_size=(128, 256))
+    if pack_shards:
+        pack_dataset(output_directory)
@@ -3,11 +3,10 @@ import torch
 import torchreid
 import numpy as np
 from torch.utils.data import Dataset, DataLoader
-from torchvision import transforms
-from PIL import Image
 import shutil
 from tqdm import tqdm
 import cv2
+from letterbox import load_image, letterbox, letterbox_collate, normalize_batch
 
 # Import Grad-CAM
 from pytorch_grad_cam import GradCAM
@@ -16,19 +15,16 @@ from pytorch_grad_cam.utils.image import show_cam_on_image, preprocess_image
 
 # Define InferenceDataset
 class InferenceDataset(Dataset):
-    def __init__(self, img_paths, transform=None):
+    def __init__(self, img_paths):
         self.img_paths = img_paths
-        self.transform = transform
 
     def __len__(self):
         return len(self.img_paths)
 
     def __getitem__(self, idx):
         img_path = self.img_paths[idx]
-        img = Image.open(img_path).convert('RGB')
-        if self.transform:
-            img = self.transform(img)
-        return img, img_path  # Return image and its path
+        # uint8 image of its own size, letterboxed and normalised per batch by letterbox_collate
+        return load_image(img_path), img_path  # Return image and its path
 
 
 def extract_features(model, loader, device):
@@ -89,15 +85,9 @@ def generate_and_save_activation_map(model, img_path, output_path, device, suffi
     - alpha: Blending factor for the activation map overlay.
     """
     try:
-        # Load and preprocess image
-        img = Image.open(img_path).convert('RGB')
-        transform = transforms.Compose([
-            transforms.Resize((256, 128)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                 std=[0.229, 0.224, 0.225]),
-        ])
-        img_tensor = transform(img).unsqueeze(0).to(device)
+        # Load and preprocess image, the same letterbox as in training
+        img = letterbox(load_image(img_path))
+        img_tensor = normalize_batch(img.unsqueeze(0)).to(device)
 
         # Forward pass to get the feature maps
         with torch.no_grad():
@@ -139,9 +129,8 @@ def generate_and_save_activation_map(model, img_path, output_path, device, suffi
             # Resize activation map to match the input image size
             activation_map_resized = cv2.resize(activation_map, (128, 256))
 
-            # Prepare image for visualization
-            img_resized = img.resize((128, 256))
-            img_np = np.array(img_resized).astype(np.float32) / 255.0  # Normalize to [0,1]
+            # Prepare image for visualization, the letterboxed model input
+            img_np = img.permute(1, 2, 0).numpy().astype(np.float32) / 255.0  # Normalize to [0,1]
             img_np = img_np[..., :3]  # Ensure 3 channels
 
             # Choose a colormap
@@ -207,20 +196,14 @@ def main():
         gallery_img_paths = [os.path.join(gallery_dir, img) for img in os.listdir(gallery_dir) if
                              img.lower().endswith(('.jpg', '.png', '.jpeg'))]
 
-        # Define transformations
-        transform = transforms.Compose([
-            transforms.Resize((256, 128)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406],  # ImageNet mean
-                                 std=[0.229, 0.224, 0.225]),  # ImageNet std
-        ])
-
         # Create datasets and loaders
-        query_dataset = InferenceDataset(query_img_paths, transform=transform)
-        gallery_dataset = InferenceDataset(gallery_img_paths, transform=transform)
+        query_dataset = InferenceDataset(query_img_paths)
+        gallery_dataset = InferenceDataset(gallery_img_paths)
 
-        query_loader = DataLoader(query_dataset, batch_size=32, shuffle=False, num_workers=4)
-        gallery_loader = DataLoader(gallery_dataset, batch_size=32, shuffle=False, num_workers=4)
+        query_loader = DataLoader(query_dataset, batch_size=32, shuffle=False, num_workers=4,
+                                  collate_fn=letterbox_collate)
+        gallery_loader = DataLoader(gallery_dataset, batch_size=32, shuffle=False, num_workers=4,
+                                    collate_fn=letterbox_collate)
 
         # Extract features
         print("Extracting features from query images...")
@@ -4,9 +4,8 @@ import torchreid
 import numpy as np
 from pathlib import Path
 from torch.utils.data import Dataset, DataLoader
-from torchvision import transforms
-from PIL import Image
 import shutil
+from letterbox import load_image, letterbox_collate
 
 model_path = '/Users/albert.bikeev/Projects/sobaken-id/re-identification/log/v0.3_vkg34900407plus/model/model.pth.tar-33'
 num_classes = 621
@@ -16,19 +15,16 @@ predictions_dir = '/Users/albert.bikeev/Projects/sobaken-id/data/predictions/cle
 
 # Define InferenceDataset
 class InferenceDataset(Dataset):
-    def __init__(self, img_paths, transform=None):
+    def __init__(self, img_paths):
         self.img_paths = img_paths
-        self.transform = transform
 
     def __len__(self):
         return len(self.img_paths)
 
     def __getitem__(self, idx):
         img_path = self.img_paths[idx]
-        img = Image.open(img_path).convert('RGB')
-        if self.transform:
-            img = self.transform(img)
-        return img, img_path  # Return image and its path
+        # uint8 image of its own size, letterboxed and normalised per batch by letterbox_collate
+        return load_image(img_path), img_path  # Return image and its path
 
 # Function to extract features
 def extract_features(model, loader, device):
@@ -106,24 +102,18 @@ if __name__ == '__main__':
     model = model.to(device)
     model.eval()
 
-    # Define transformations
-    transform = transforms.Compose([
-        transforms.Resize((256, 128)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406],  # ImageNet mean
-                             std=[0.229, 0.224, 0.225]),  # ImageNet std
-    ])
-
     # Get image paths
     query_img_paths = [os.path.join(query_dir, img) for img in os.listdir(query_dir) if img.endswith('.jpg')]
     gallery_img_paths = [os.path.join(gallery_dir, img) for img in os.listdir(gallery_dir) if img.endswith('.jpg')]
 
     # Create datasets and loaders
-    query_dataset = InferenceDataset(query_img_paths, transform=transform)
-    gallery_dataset = InferenceDataset(gallery_img_paths, transform=transform)
+    query_dataset = InferenceDataset(query_img_paths)
+    gallery_dataset = InferenceDataset(gallery_img_paths)
 
-    query_loader = DataLoader(query_dataset, batch_size=32, shuffle=False, num_workers=4)
-    gallery_loader = DataLoader(gallery_dataset, batch_size=32, shuffle=False, num_workers=4)
+    query_loader = DataLoader(query_dataset, batch_size=32, shuffle=False, num_workers=4,
+                              collate_fn=letterbox_collate)
+    gallery_loader = DataLoader(gallery_dataset, batch_size=32, shuffle=False, num_workers=4,
+                                collate_fn=letterbox_collate)
 
     # Extract features
     print("Extracting features from query images...")
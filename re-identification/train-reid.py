@@ -2,6 +2,8 @@ import torch
 import torchreid
 from torchreid.engine import ImageTripletEngine, ImageSoftmaxEngine
 from my_datasets.vkg34900407plus import Vkg34900407plus
+from my_datasets.image_cache import with_image_cache
+from identity_sampler import use_identity_sampler
 import wandb
 
 training_model_version = '0.3_vkg34900407plus'
@@ -18,6 +20,15 @@ if __name__ == '__main__':
     config.dataset_name = dataset.name
 
     config.transforms = ['random_flip', 'random_crop', 'random_erase']
+    # Keep decoded images in a shared memory mapped cache, ~96 KB per image (see my_datasets/image_cache.py)
+    config.cache_images = False
+    config.batch_size = 32
+    config.num_instances = 4
+    # torchreid's sampler, or opt in to 'ArrayIdentitySampler' (same sampling, faster epoch start) or
+    # 'HardNegativeIdentitySampler' of identity_sampler.py, which replace the train loader
+    config.train_sampler = 'RandomIdentitySampler'
+    config.hard_negative_refresh_every = 5  # Epochs between embedding the train set
+    config.hard_negative_neighbours = 20
 
     config.optimizer = 'adam'
     config.loss = 'triplet'
@@ -30,7 +41,10 @@ if __name__ == '__main__':
 
     print(f'train_model_version: {training_model_version}, configuration: {config}')
 
+    if config.cache_images:
+        dataset = with_image_cache(dataset)
     torchreid.data.register_image_dataset(dataset.name, dataset)
+    our_samplers = ('ArrayIdentitySampler', 'HardNegativeIdentitySampler')
 
     # Create the data manager
     datamanager = torchreid.data.ImageDataManager(
@@ -38,11 +52,12 @@ if __name__ == '__main__':
         sources=dataset.name,
         height=256,
         width=128,
-        batch_size_train=32,
+        batch_size_train=config.batch_size,
         batch_size_test=100,
         transforms=config.transforms,
-        num_instances=4,
-        train_sampler='RandomIdentitySampler',
+        num_instances=config.num_instances,
+        # Our samplers replace the train loader below, don't let torchreid build its identity index as well
+        train_sampler='RandomSampler' if config.train_sampler in our_samplers else config.train_sampler,
     )
 
     print(f"Number of training identities: {datamanager.num_train_pids}")
@@ -58,6 +73,15 @@ if __name__ == '__main__':
     # Move the model to GPU if available
     model = model.cuda() if torch.cuda.is_available() else model
 
+    if config.train_sampler == 'ArrayIdentitySampler':
+        use_identity_sampler(datamanager, config.batch_size, config.num_instances)
+    elif config.train_sampler == 'HardNegativeIdentitySampler':
+        # Embeddings are cached per epoch and per run, runs with the same version never share them
+        use_identity_sampler(datamanager, config.batch_size, config.num_instances, model=model,
+                             refresh_every=config.hard_negative_refresh_every,
+                             num_neighbours=config.hard_negative_neighbours,
+                             cache_dir=f'{save_dir}/hard_negatives/{run.id}')
+
     # Print model's classifier output dimension
     print(f"Model's classifier output dimension: {model.classifier.out_features}")
 
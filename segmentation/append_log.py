@@ -0,0 +1,26 @@
+import os
+
+#### Docs:
+# Helpers for the append-only line files of the segmentation scripts (completion logs and mask stores of
+# bulk-segment-and-clip.py, annotation lines of yolov8_segment_with_annotations.py): a crash can leave the last line
+# without its newline, readers skip such a line and writers cut it before appending on resume.
+
+
+def truncate_torn_line(path):
+    """
+    Cuts a last line torn by a crash (no trailing newline) off an append-only file, so the next line appended on
+    resume starts on a line of its own instead of being glued to the fragment.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - 65536)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline != -1:
+                f.truncate(start + newline + 1)
+                return
+            end = start
+        f.truncate(0)
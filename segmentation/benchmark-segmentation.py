@@ -0,0 +1,175 @@
+import os
+import sys
+import glob
+import json
+import time
+import resource
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import cv2
+import numpy as np
+from pycocotools import mask as mask_util
+from segmenters import build_segmenter
+
+#### Docs:
+# Throughput and quality of segmentation setups on a fixed sample, so backend and resolution choices are data-driven.
+# Every run is a setup of segmenters.build_segmenter and is measured in a fresh process, so peak RSS is its own:
+# - images/s, p50/p95 latency per image (batch latency / batch size) on sample_size images of sample_directory
+# - hit rate: share of the sample with a target object found
+# - mask IoU of the best (top score) mask with the union of the labelled masks of an image, on a small labelled set
+#   in COCO format (RLE or polygons, e.g. annotations_coco.json of yolov8_segment_with_annotations.py after manual
+#   review), images with no mask found count as IoU 0
+# - agreement: mean IoU of the best mask with the best mask of reference_run on the unlabelled sample, as a check of
+#   a faster backend against PointRend without labels (images where neither finds a mask agree, 1.0)
+# Results are printed and appended to results_file, one JSON line per run.
+
+# ----------------------- Configuration Parameters -----------------------
+
+sample_directory = '/Users/albert.bikeev/Projects/sobaken-id/data/raw/vk_posts_dedup/clustered_part_6/vkg34900407_DEDUP_catsdogs_enriched/together'
+sample_size = 200
+labels_file = '/Users/albert.bikeev/Projects/sobaken-id/data/segmentation_benchmark/annotations_coco.json'  # None to skip IoU
+labels_image_directory = '/Users/albert.bikeev/Projects/sobaken-id/data/segmentation_benchmark/images'
+results_file = 'segmentation_benchmark.jsonl'
+reference_run = 'pointrend'  # Name of the run others are compared to on the sample, runs first, None to skip
+
+target_classes = ['cat', 'dog', 'bear', 'bird', 'horse', 'sheep', 'cow']
+batch_size = 8
+
+runs = [
+    {'name': 'pointrend', 'backend': 'pointrend',
+     'model_path': '/Users/albert.bikeev/Projects/sobaken-id/trained_models/segm_PixelLib_pointrend_resnet50.pkl'},
+    {'name': 'pointrend@512', 'backend': 'pointrend', 'min_size': 512, 'max_size': 853,
+     'model_path': '/Users/albert.bikeev/Projects/sobaken-id/trained_models/segm_PixelLib_pointrend_resnet50.pkl'},
+    {'name': 'yolov8n-seg', 'backend': 'yolov8', 'model_path': 'yolov8n-seg.pt'},
+    {'name': 'yolov8n-seg@1024', 'backend': 'yolov8', 'model_path': 'yolov8n-seg.pt', 'image_size': 1024},
+    {'name': 'dog_detection_model', 'backend': 'yolov8', 'model_path': 'dog_detection_model.pt'},
+    {'name': 'yolov8n+yolov8n-seg', 'backend': 'yolov8', 'model_path': 'yolov8n-seg.pt', 'detector_path': 'yolov8n.pt'},
+]
+
+# ------------------------------------------------------------------------
+
+
+def load_labelled_masks(labels_path, image_directory):
+    """
+    Returns:
+        dict: Image path -> union of its labelled masks (H, W) bool.
+    """
+    with open(labels_path, 'r', encoding='utf-8') as f:
+        coco = json.load(f)
+    images = {image['id']: image for image in coco['images']}
+    masks = {image_id: np.zeros((image['height'], image['width']), dtype=bool) for image_id, image in images.items()}
+    for annotation in coco['annotations']:
+        image = images[annotation['image_id']]
+        segmentation = annotation['segmentation']
+        if isinstance(segmentation, list):  # Polygons
+            rle = mask_util.merge(mask_util.frPyObjects(segmentation, image['height'], image['width']))
+        elif isinstance(segmentation['counts'], list):  # Uncompressed RLE
+            rle = mask_util.frPyObjects(segmentation, image['height'], image['width'])
+        else:
+            rle = segmentation
+        masks[annotation['image_id']] |= mask_util.decode(rle).astype(bool)
+    return {os.path.join(image_directory, images[image_id]['file_name']): mask for image_id, mask in masks.items()}
+
+
+def read_images(image_paths):
+    with ThreadPoolExecutor() as pool:
+        return [(path, image) for path, image in zip(image_paths, pool.map(cv2.imread, image_paths))
+                if image is not None]
+
+
+def best_mask(object_info):
+    if len(object_info['scores']) == 0:
+        return None
+    return object_info['masks'][:, :, int(np.argmax(object_info['scores']))]
+
+
+def mask_iou(mask1, mask2):
+    union = np.logical_or(mask1, mask2).sum()
+    return np.logical_and(mask1, mask2).sum() / union if union else 1.0
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+
+def benchmark_run(run, sample_paths):
+    setup = {k: v for k, v in run.items() if k not in ('name', 'backend', 'model_path')}
+    segmenter = build_segmenter(run['backend'], run['model_path'], target_classes, **setup)
+    images = read_images(sample_paths)
+    segmenter.segment_batch([images[0][1]])  # Warm-up, the first call initialises lazily
+
+    latencies, hits, best_masks = [], 0, {}
+    elapsed = 0.0
+    for i in range(0, len(images), batch_size):
+        batch = images[i:i + batch_size]
+        batch_start = time.perf_counter()
+        object_infos = segmenter.segment_batch([image for _, image in batch])
+        batch_s = time.perf_counter() - batch_start
+        elapsed += batch_s
+        latencies += [batch_s / len(batch)] * len(batch)
+        hits += sum(len(object_info['scores']) > 0 for object_info in object_infos)
+        # Outside the timing, RLE keeps the masks small enough to send back to the main process
+        for (path, _), object_info in zip(batch, object_infos):
+            mask = best_mask(object_info)
+            best_masks[path] = None if mask is None else mask_util.encode(np.asfortranarray(mask.astype(np.uint8)))
+    del images
+
+    result = {
+        'name': run['name'],
+        'images': len(latencies),
+        'images_per_s': round(len(latencies) / elapsed, 2),
+        'latency_p50_ms': round(float(np.percentile(latencies, 50)) * 1000, 1),
+        'latency_p95_ms': round(float(np.percentile(latencies, 95)) * 1000, 1),
+        'hit_rate': round(hits / len(latencies), 3),
+    }
+
+    if labels_file is not None:
+        labelled_masks = load_labelled_masks(labels_file, labels_image_directory)
+        ious = []
+        labelled_images = read_images(sorted(labelled_masks))
+        for i in range(0, len(labelled_images), batch_size):
+            batch = labelled_images[i:i + batch_size]
+            for (path, _), object_info in zip(batch, segmenter.segment_batch([image for _, image in batch])):
+                mask = best_mask(object_info)
+                ious.append(0.0 if mask is None else mask_iou(mask, labelled_masks[path]))
+        result['labelled_images'] = len(ious)
+        result['mask_iou'] = round(float(np.mean(ious)), 3) if ious else None
+
+    result['peak_rss_mb'] = round(peak_rss_mb())
+    return result, best_masks
+
+
+def mask_agreement(best_masks, reference_masks):
+    ious = []
+    for path in best_masks.keys() & reference_masks.keys():
+        mask, reference = best_masks[path], reference_masks[path]
+        if mask is None or reference is None:
+            ious.append(float(mask is None and reference is None))
+        else:
+            ious.append(mask_iou(mask_util.decode(mask).astype(bool), mask_util.decode(reference).astype(bool)))
+    return round(float(np.mean(ious)), 3) if ious else None
+
+
+if __name__ == '__main__':
+
+    sample_paths = sorted(glob.glob(os.path.join(sample_directory, '*.jpg')))[:sample_size]
+    print(f"Benchmarking {len(runs)} runs on {len(sample_paths)} sample images.")
+
+    reference_masks = None
+    for run in sorted(runs, key=lambda run: run['name'] != reference_run):
+        # A fresh process per run, so peak RSS and lazily loaded libraries don't leak between runs
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            result, best_masks = pool.submit(benchmark_run, run, sample_paths).result()
+        if run['name'] == reference_run:
+            reference_masks = best_masks
+        elif reference_masks is not None:
+            result[f'agreement_with_{reference_run}'] = mask_agreement(best_masks, reference_masks)
+        print(f"{result['name']}: {result['images_per_s']} images/s, latency p50 {result['latency_p50_ms']} ms, "
+              f"p95 {result['latency_p95_ms']} ms, hit rate {result['hit_rate']}, mask IoU {result.get('mask_iou')} "
+              f"on {result.get('labelled_images', 0)} labelled images, "
+              f"agreement with {reference_run} {result.get(f'agreement_with_{reference_run}')}, "
+              f"peak RSS {result['peak_rss_mb']} MB")
+        with open(results_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({**result, 'run': run, 'batch_size': batch_size,
+                                'date': time.strftime('%Y-%m-%d %H:%M:%S')}) + '\n')
@@ -1,88 +1,374 @@
 import os
 import glob
+import json
+import time
+import hashlib
 from pathlib import Path
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import cv2
 import numpy as np
+import torch
 from tqdm import tqdm
-from pixellib.torchbackend.instance import instanceSegmentation
+from segmenters import PointRendSegmenter, build_segmenter
+from mask_store import store_path, encode_objects, read_mask_store, to_object_info
+from append_log import truncate_torn_line
+from segmentation_cache import SegmentationCache, setup_key
+from instance_association import select_instances, InstanceEmbedder, associate_instances
 
 # ----------------------- Configuration Parameters -----------------------
 
 input_directories = '/Users/albert.bikeev/Projects/sobaken-id/data/raw/vk_posts_dedup/clustered_part_6/vkg34900407_DEDUP_catsdogs_enriched/together'
 output_directory = '/Users/albert.bikeev/Projects/sobaken-id/data/segmented/vk_posts/vkg34900407plus_DEDUP_enriched'
-model_file = '/Users/albert.bikeev/Projects/sobaken-id/trained_models/segm_PixelLib_pointrend_resnet50.pkl'
+# Segmentation backend and its model: 'pointrend' (PixelLib .pkl) or 'yolov8' (Ultralytics -seg .pt), see segmenters.py
+model_files = {
+    'pointrend': '/Users/albert.bikeev/Projects/sobaken-id/trained_models/segm_PixelLib_pointrend_resnet50.pkl',
+    'yolov8': 'yolov8n-seg.pt',
+}
+backend = 'pointrend'
+# YOLOv8 detection model (e.g. 'yolov8n.pt') for two-stage mode: detect at low resolution, segment box crops only.
+# None segments full images
+detector_file = None
+
+# Define the target animal classes (you can adjust this list as needed)
+target_classes = ['cat', 'dog', 'bear', 'bird', 'horse', 'sheep', 'cow']
+segmenter_confidence = 0.5
+
+# Content-addressed cache of segmentation results shared by all runs and output dirs (see segmentation_cache.py),
+# None to always run the model
+cache_dir = '/Users/albert.bikeev/Projects/sobaken-id/data/segmented/cache'
+
+batch_size = 8  # Images per model call
+num_threads = 4  # Threads decoding the next batch and post-processing/saving masks while the model runs
+num_processes = 1  # Processes, each with its own model, the images are split between them
+completion_log_prefix = 'segmentation_done_'  # Per-process logs of processed images in the output dir, for resuming
+
+# 'masks': keep RLE masks, boxes and scores of all objects in the mask store (see mask_store.py) and materialise crops
+# from it, so a crop policy change doesn't need the model; 'crops': only write the clipped JPEGs
+output_format = 'masks'
+materialise_only = False  # Re-crop everything from the mask store without running the model
+
+# 'best': a crop of the best object per image. 'all' (needs 'masks' output): a crop per object above
+# instance_score_threshold, objects of a post are associated into animals (see instance_association.py) and posts with
+# several animals get an identity per animal: vkg<GROUP_ID>_<POST_ID>-<ANIMAL>_<IMAGE_NUM>.jpg
+instances = 'best'
+instance_score_threshold = 0.7
+max_instances_per_image = 4
+association_model_file = None  # Re-ID checkpoint (osnet_x1_0), None for ImageNet-pretrained osnet_x0_25
+association_num_classes = 621
+association_similarity_threshold = 0.6
+instances_log_name = 'instances.tsv'  # file_name, image, object index in the mask store record, animal per crop
+post_done_marker = '#done'  # Instances log line '#done\t<GROUP_ID>_<POST_ID>' after the last crop of a post
+
+benchmark = False  # Compare images/s of the batched pipeline against the per-image loop instead of segmenting
+benchmark_masks = False  # Time mask selection and cropping on a synthetic 12-MP image instead of segmenting
+benchmark_sample_size = 64
 
 # ------------------------------------------------------------------------
 
-def segment_images(input_raw_ds_path, output_segmented_ds_dir, model_path,
-                   save_as_flat_files=False, best_mask_based_on_area=False):
-    Path(output_segmented_ds_dir).mkdir(parents=True, exist_ok=True)
-    # Initialize the segmentation model
-    segmenter = instanceSegmentation()
-    segmenter.load_model(model_path)
+def parse_image_path(image_path):
+    filename = os.path.basename(image_path)
+    base_name, ext = os.path.splitext(filename)
+    if '_' in base_name:
+        group_id, post_id, image_num = base_name.split('_')
+        group_id = group_id[3:]
+        return group_id + '_' + post_id, image_num
+    else:
+        print(f"Skipping file with unexpected format: {filename}")
+        return None
 
-    # Define the target animal classes (you can adjust this list as needed)
-    target_classes = segmenter.select_target_classes(cat=True, dog=True, bear=True, bird=True, horse=True,
-                                                     sheep=True, cow=True)
 
-    # Collect all images in the input directory
-    image_paths = glob.glob(os.path.join(input_raw_ds_path, '*.jpg'))
-
-    # Process images individually (tqdm thingy prints the processing status in the console)
-    for image_path in tqdm(image_paths, desc="Segmenting images"):
-        filename = os.path.basename(image_path)
-        base_name, ext = os.path.splitext(filename)
-        if '_' in base_name:
-            group_id, post_id, image_num = base_name.split('_')
-            group_id = group_id[3:]
-            group_post_id = group_id + '_' + post_id
-        else:
-            print(f"Skipping file with unexpected format: {filename}")
-            continue
-
-        # Read the image
-        image = cv2.imread(image_path)
+def segment_images(input_raw_ds_path, output_segmented_ds_dir, backend, model_path, detector_path=None,
+                   save_as_flat_files=False, best_mask_based_on_area=False, num_processes=1, output_format='crops',
+                   cache_dir=None):
+    Path(output_segmented_ds_dir).mkdir(parents=True, exist_ok=True)
 
-        # Segment the image
-        result = segmenter.segmentImage(
-            image_path,
-            extract_segmented_objects=True,
-            save_extracted_objects=False,  # We'll handle saving manually
-            segment_target_classes=target_classes,
-            show_bboxes=False,
-            output_image_name=None  # We don't need the output image with masks
-        )
-
-        # Get details of detected objects
-        object_info = result[0]
-
-        if best_mask_based_on_area:
-            best_mask_index = find_best_area_mask_ind(object_info)
-        else:
-            best_mask_index = find_top_score_mask_ind(object_info)
-        if best_mask_index is None:
-            print(f"No target objects found in image: {filename}")
+    # Collect all images in the input directory
+    tasks = []
+    for image_path in glob.glob(os.path.join(input_raw_ds_path, '*.jpg')):
+        parsed = parse_image_path(image_path)
+        if parsed is None:
             continue
-
-        # Get the mask of the object with the highest score
-        best_mask = object_info['masks'][:, :, best_mask_index]
-
-        # Extract the object using the mask
-        masked_image = apply_mask_and_crop(image, best_mask)
-
-        # Save the segmented object image
+        group_post_id, image_num = parsed
+        # Save the image with a meaningful name
         if save_as_flat_files:
             final_output_dir = output_segmented_ds_dir
         else:
             final_output_dir = os.path.join(output_segmented_ds_dir, group_post_id)
-            # Create the final output directory for this animal (post_id)
-            os.makedirs(final_output_dir, exist_ok=True)
+        tasks.append((image_path, os.path.join(final_output_dir, f"vkg{group_post_id}_{image_num}.jpg")))
+
+    # Resume: skip images recorded in a completion log (e.g. no target objects found) or, for crops, with an output
+    done = read_completion_logs(output_segmented_ds_dir)
+    todo = [(image_path, output_path) for image_path, output_path in sorted(tasks)
+            if image_path not in done and (output_format == 'masks' or not os.path.exists(output_path))]
+    print(f"{len(tasks) - len(todo)} images are already processed, {len(todo)} to segment.")
+
+    # Every process holds its own model and segments every num_processes-th image
+    shards = [todo[i::num_processes] for i in range(num_processes)]
+    if num_processes == 1:
+        shards_stats = [segment_shard(0, shards[0], backend, model_path, detector_path, output_segmented_ds_dir,
+                                      output_format, best_mask_based_on_area, cache_dir)]
+    else:
+        with ProcessPoolExecutor(max_workers=num_processes) as pool:
+            shards_stats = list(pool.map(segment_shard, range(num_processes), shards, [backend] * num_processes,
+                                         [model_path] * num_processes, [detector_path] * num_processes,
+                                         [output_segmented_ds_dir] * num_processes, [output_format] * num_processes,
+                                         [best_mask_based_on_area] * num_processes, [cache_dir] * num_processes,
+                                         [max(1, os.cpu_count() // num_processes)] * num_processes))
+
+    stats = Counter()
+    for shard_stats in shards_stats:
+        stats.update(shard_stats)
+    print(f"Segmentation and organization complete: {stats['segmented']} segmented, "
+          f"{stats['no_objects']} without target objects, {stats['unreadable']} unreadable, "
+          f"{stats['cache_hits']} taken from the cache.")
+
+
+def read_completion_logs(output_segmented_ds_dir):
+    done = set()
+    for log_path in glob.glob(os.path.join(output_segmented_ds_dir, f"{completion_log_prefix}*.log")):
+        with open(log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.endswith('\n'):  # The last line may be torn by a crash
+                    done.add(line.split('\t')[0])
+    return done
+
+
+def segment_shard(shard_ind, tasks, backend, model_path, detector_path, output_segmented_ds_dir, output_format,
+                  best_mask_based_on_area, cache_dir=None, torch_threads=None):
+    """
+    Segments tasks (image path, output path) with a model of its own, every processed image is appended
+    to the shard's completion log as 'image_path<TAB>status' once its output (crop or mask store record) is written.
+    Images found in the segmentation cache (by content) skip the model.
+
+    Returns:
+        Counter: Number of images per status: segmented, no_objects, unreadable, and cache_hits.
+    """
+    if torch_threads is not None:
+        # Otherwise every process starts a thread per core and they fight for the cores
+        torch.set_num_threads(torch_threads)
+    stats = Counter()
+    if not tasks:
+        return stats
+    segmenter = build_segmenter(backend, model_path, target_classes, confidence=segmenter_confidence,
+                                detector_path=detector_path)
+    cache = None
+    if cache_dir is not None:
+        cache = SegmentationCache(cache_dir, setup_key(backend, model_path, detector_path, target_classes,
+                                                       segmenter_confidence))
+
+    def load_image(image_path):
+        # Bytes are read once for both the content hash and decoding
+        try:
+            with open(image_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None, None, None
+        digest = hashlib.sha1(data).hexdigest() if cache is not None else None
+        cached = cache.get(digest) if cache is not None else None
+        # A cached mask store record doesn't need the image, crops do
+        image = None
+        if cached is None or output_format == 'crops':
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return digest, cached, image
+
+    def save_outputs(image_path, output_image_path, image, digest, object_info=None, cached=None):
+        file_name = os.path.relpath(output_image_path, output_segmented_ds_dir)
+        record = None
+        if cached is not None:
+            record = {'image': image_path, 'file_name': file_name, **cached}
+            object_info = to_object_info(record)
+        elif output_format == 'masks' or cache is not None:
+            record = encode_objects(image_path, file_name, object_info)
+            if cache is not None:
+                cache.put(digest, record)
+        if output_format == 'masks':
+            return record
+        return save_best_object(image, object_info, image_path, output_image_path, best_mask_based_on_area)
+
+    completion_log_path = os.path.join(output_segmented_ds_dir, f"{completion_log_prefix}{shard_ind}.log")
+    mask_store_path = store_path(output_segmented_ds_dir, shard_ind)
+    truncate_torn_line(completion_log_path)
+    truncate_torn_line(mask_store_path)
+    batches = [tasks[i:i + batch_size] for i in range(0, len(tasks), batch_size)]
+    with ThreadPoolExecutor(max_workers=num_threads) as pool, \
+            open(completion_log_path, 'a', encoding='utf-8') as completion_log, \
+            open(mask_store_path, 'a', encoding='utf-8') as mask_store, \
+            tqdm(total=len(tasks), desc=f"Segmenting images (shard {shard_ind})", position=shard_ind) as bar:
+        # Every image is decoded once, the next batch is decoded while the model runs on the current one
+        loading = [pool.submit(load_image, image_path) for image_path, _ in batches[0]]
+        prev_saving = []
+        for batch_ind, batch in enumerate(batches):
+            loaded = [f.result() for f in loading]
+            if batch_ind + 1 < len(batches):
+                loading = [pool.submit(load_image, image_path) for image_path, _ in batches[batch_ind + 1]]
+
+            saving, to_segment = [], []
+            for (image_path, output_image_path), (digest, cached, image) in zip(batch, loaded):
+                if image is None and (cached is None or output_format == 'crops'):
+                    print(f"Could not read image: {image_path}")
+                    completion_log.write(f"{image_path}\tunreadable\n")
+                    stats['unreadable'] += 1
+                elif cached is not None:
+                    saving.append((image_path, pool.submit(save_outputs, image_path, output_image_path, image, digest,
+                                                           cached=cached)))
+                    stats['cache_hits'] += 1
+                else:
+                    to_segment.append((image_path, output_image_path, image, digest))
+            object_infos = segmenter.segment_batch([image for _, _, image, _ in to_segment]) if to_segment else []
+
+            saving += [(image_path, pool.submit(save_outputs, image_path, output_image_path, image, digest,
+                                                object_info=object_info))
+                       for (image_path, output_image_path, image, digest), object_info in zip(to_segment, object_infos)]
+            # Wait for the previous batch only, so at most two batches of decoded images are held in memory
+            write_completed(prev_saving, completion_log, mask_store, stats)
+            prev_saving = saving
+            bar.update(len(batch))
+        write_completed(prev_saving, completion_log, mask_store, stats)
+    return stats
+
+
+def write_completed(saving, completion_log, mask_store, stats):
+    """
+    Saving futures return a mask store record (masks output) or whether a crop was saved (crops output).
+    """
+    for image_path, f in saving:
+        result = f.result()
+        if isinstance(result, dict):
+            mask_store.write(json.dumps(result) + '\n')
+            result = bool(result['objects'])
+        status = 'segmented' if result else 'no_objects'
+        completion_log.write(f"{image_path}\t{status}\n")
+        stats[status] += 1
+    # The store goes first, so an image in a completion log always has its record
+    mask_store.flush()
+    completion_log.flush()
+
+
+def materialise_crops(output_segmented_ds_dir, best_mask_based_on_area=False, overwrite=False):
+    """
+    Writes the crop of the best object of every image in the mask store, the mask is decoded for it only.
+    Existing crops are kept unless overwrite.
+    """
+    records = [record for record in read_mask_store(output_segmented_ds_dir).values() if record['objects']
+               and (overwrite or not os.path.exists(os.path.join(output_segmented_ds_dir, record['file_name'])))]
+
+    def materialise(record):
+        image = cv2.imread(record['image'])
+        if image is None:
+            print(f"Could not read image: {record['image']}")
+            return False
+        return save_best_object(image, to_object_info(record), record['image'],
+                                os.path.join(output_segmented_ds_dir, record['file_name']), best_mask_based_on_area)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        saved = sum(tqdm(pool.map(materialise, records), total=len(records), desc="Materialising crops"))
+    print(f"Materialised {saved} crops from the mask store.")
+
+
+def instance_file_name(file_name, animal, num_animals):
+    if num_animals == 1:
+        return file_name
+    stem, ext = os.path.splitext(file_name)
+    group_id, post_id, image_num = stem.rsplit('_', 2)
+    return f"{group_id}_{post_id}-{animal + 1}_{image_num}{ext}"
+
+
+def materialise_instances(output_segmented_ds_dir, overwrite=False):
+    """
+    Writes a crop per instance of every image in the mask store, with an identity per animal of a post.
+    Posts with a done marker in the instances log are kept unless overwrite. Lines after the last marker are of a post
+    cut by a crash: they are cut from the log and the post is redone.
+    """
+    log_path = os.path.join(output_segmented_ds_dir, instances_log_name)
+    done_posts = set()
+    if os.path.exists(log_path) and not overwrite:
+        complete_size = size = 0
+        with open(log_path, 'rb') as f:
+            for line in f:
+                size += len(line)
+                fields = line.decode('utf-8', errors='replace').rstrip('\n').split('\t')
+                if fields[0] == post_done_marker and line.endswith(b'\n'):
+                    done_posts.add(fields[1])
+                    complete_size = size
+        os.truncate(log_path, complete_size)
+
+    post_records = {}
+    for image_path, record in sorted(read_mask_store(output_segmented_ds_dir).items()):
+        group_post_id = parse_image_path(image_path)[0]
+        if record['objects'] and group_post_id not in done_posts:
+            post_records.setdefault(group_post_id, []).append(record)
+
+    embedder = None
+    stats = Counter()
+
+    def crop_instances(record):
+        image = cv2.imread(record['image'])
+        if image is None:
+            print(f"Could not read image: {record['image']}")
+            return []
+        object_info = to_object_info(record)
+        indices = select_instances(object_info, instance_score_threshold, max_instances_per_image)
+        crops = [(i, apply_mask_and_crop(image, object_info['masks'][:, :, i])) for i in indices]
+        return [(i, crop) for i, crop in crops if crop is not None]
+
+    with ThreadPoolExecutor(max_workers=num_threads) as pool, \
+            open(log_path, 'w' if overwrite else 'a', encoding='utf-8') as log:
+        for group_post_id, records in tqdm(post_records.items(), desc="Materialising instances"):
+            images_instances = list(pool.map(crop_instances, records))
+            instances_per_image = [len(image_instances) for image_instances in images_instances]
+            if max(instances_per_image) <= 1:
+                animals = np.zeros(sum(instances_per_image), dtype=np.int64)
+            else:
+                if embedder is None:
+                    embedder = InstanceEmbedder(association_model_file, association_num_classes)
+                embeddings = embedder.embed([crop for image_instances in images_instances for _, crop in image_instances])
+                animals = associate_instances(instances_per_image, embeddings, association_similarity_threshold)
+            num_animals = int(animals.max()) + 1 if len(animals) else 0
+            stats['posts'] += 1
+            stats['multi_animal_posts'] += num_animals > 1
+
+            animal_iter = iter(animals.tolist())
+            for record, image_instances in zip(records, images_instances):
+                for object_ind, crop in image_instances:
+                    animal = next(animal_iter)
+                    file_name = instance_file_name(record['file_name'], animal, num_animals)
+                    output_image_path = os.path.join(output_segmented_ds_dir, file_name)
+                    os.makedirs(os.path.dirname(output_image_path), exist_ok=True)
+                    cv2.imwrite(output_image_path, crop)
+                    log.write(f"{file_name}\t{record['image']}\t{object_ind}\t{animal}\n")
+                    stats['crops'] += 1
+            log.write(f"{post_done_marker}\t{group_post_id}\n")
+            log.flush()
+    print(f"Materialised {stats['crops']} instance crops of {stats['posts']} posts, "
+          f"{stats['multi_animal_posts']} posts with several animals.")
+
+
+def crop_best_object(image, object_info, best_mask_based_on_area=False):
+    if best_mask_based_on_area:
+        best_mask_index = find_best_area_mask_ind(object_info)
+    else:
+        best_mask_index = find_top_score_mask_ind(object_info)
+    if best_mask_index is None:
+        return None
 
-        # Save the image with a meaningful name
-        output_image_path = os.path.join(final_output_dir, f"vkg{group_post_id}_{image_num}.jpg")
-        cv2.imwrite(output_image_path, masked_image)
+    # Get the mask of the object with the highest score
+    best_mask = object_info['masks'][:, :, best_mask_index]
+
+    # Extract the object using the mask
+    return apply_mask_and_crop(image, best_mask)
+
+
+def save_best_object(image, object_info, image_path, output_image_path, best_mask_based_on_area):
+    masked_image = crop_best_object(image, object_info, best_mask_based_on_area)
+    if masked_image is None:
+        print(f"No target objects found in image: {os.path.basename(image_path)}")
+        return False
 
-    print("Segmentation and organization complete.")
+    # Save the segmented object image
+    os.makedirs(os.path.dirname(output_image_path), exist_ok=True)
+    cv2.imwrite(output_image_path, masked_image)
+    return True
 
 
 def find_top_score_mask_ind(object_info: dict):
@@ -112,12 +398,12 @@ def find_best_area_mask_ind(object_info: dict):
         # Take the top three objects
         top_three_indices = sorted_indices[:3]
 
-        # Compute the area (number of pixels) for each of the top three masks
-        areas = []
-        for idx in top_three_indices:
-            mask = object_info['masks'][:, :, idx]
-            area = np.sum(mask)
-            areas.append(area)
+        # Area (number of pixels) of each of the top three masks, segmenters and the mask store provide them,
+        # PixelLib's segmentImage output doesn't
+        if 'areas' in object_info:
+            areas = object_info['areas'][top_three_indices]
+        else:
+            areas = np.count_nonzero(object_info['masks'][:, :, top_three_indices], axis=(0, 1))
 
         # Select the index with the largest area among the top three
         max_area_index = np.argmax(areas)
@@ -125,22 +411,112 @@ def find_best_area_mask_ind(object_info: dict):
 
 
 def apply_mask_and_crop(image, mask):
-    # Apply the mask to the image to extract the object
+    if mask.dtype != bool:
+        mask = mask != 0
+
+    # Find the bounding box of the non-zero regions in the mask first
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(mask[rows[0]:rows[-1] + 1].any(axis=0))
+    y1, y2, x1, x2 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+    # Apply the mask to the cropped region only, uint8 * bool stays uint8
+    return image[y1:y2, x1:x2] * mask[y1:y2, x1:x2, None]
+
+
+def apply_mask_and_crop_full_image(image, mask):
+    # The previous implementation, kept as the baseline of benchmark_mask_post_processing
     mask = mask.astype(bool)
-    # Extract the object
     result = image * mask[:, :, None]
-
-    # Find the bounding box of the non-zero regions in the mask
     coords = cv2.findNonZero(mask.astype(np.uint8))
     x, y, w, h = cv2.boundingRect(coords)
-
-    # Crop the result to the bounding box
-    cropped_result = result[y:y + h, x:x + w]
-
-    return cropped_result
+    return result[y:y + h, x:x + w]
+
+
+def benchmark_mask_post_processing(height=3000, width=4000, num_objects=5, repeats=10):
+    """
+    Prints ms per image of the previous and current mask post-processing (best by area + crop) on a synthetic
+    12-MP original with num_objects elliptic masks.
+    """
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    masks = np.zeros((num_objects, height, width), dtype=bool)
+    for i in range(num_objects):
+        axes = (int(rng.integers(width // 10, width // 4)), int(rng.integers(height // 10, height // 4)))
+        center = (int(rng.integers(axes[0], width - axes[0])), int(rng.integers(axes[1], height - axes[1])))
+        ellipse = np.zeros((height, width), dtype=np.uint8)
+        cv2.ellipse(ellipse, center, axes, 0, 0, 360, 1, -1)
+        masks[i] = ellipse.astype(bool)
+    object_info = {'scores': rng.random(num_objects), 'masks': masks.transpose(1, 2, 0)}
+
+    def previous(object_info):
+        top_three_indices = np.argsort(object_info['scores'])[::-1][:3]
+        areas = [np.sum(object_info['masks'][:, :, idx]) for idx in top_three_indices]
+        best_mask = object_info['masks'][:, :, top_three_indices[np.argmax(areas)]]
+        return apply_mask_and_crop_full_image(image, best_mask)
+
+    def current(object_info):
+        return crop_best_object(image, object_info, best_mask_based_on_area=True)
+
+    assert np.array_equal(previous(object_info), current(object_info))
+    for name, post_process in [('previous', previous), ('current', current)]:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            post_process(object_info)
+        print(f"{name}: {(time.perf_counter() - start) / repeats * 1000:.1f} ms per {width}x{height} image")
+
+
+def benchmark_against_per_image_loop(input_raw_ds_path, model_path, sample_size):
+    """
+    Prints images/s on CPU of the old per-image loop (PixelLib segmentImage + a separate cv2.imread of the same file)
+    and of the batched pipeline on the same sample, nothing is saved.
+    """
+    image_paths = sorted(glob.glob(os.path.join(input_raw_ds_path, '*.jpg')))[:sample_size]
+    segmenter = PointRendSegmenter(model_path, target_classes)
+    pixellib_target_classes = segmenter.segmenter.select_target_classes(**{c: True for c in target_classes})
+
+    start = time.perf_counter()
+    for image_path in tqdm(image_paths, desc="Per-image loop"):
+        image = cv2.imread(image_path)
+        result = segmenter.segmenter.segmentImage(image_path, extract_segmented_objects=True,
+                                                  save_extracted_objects=False,
+                                                  segment_target_classes=pixellib_target_classes,
+                                                  show_bboxes=False, output_image_name=None)
+        crop_best_object(image, result[0])
+    per_image_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        for i in tqdm(range(0, len(image_paths), batch_size), desc="Batched pipeline"):
+            images = [image for image in pool.map(cv2.imread, image_paths[i:i + batch_size]) if image is not None]
+            object_infos = segmenter.segment_batch(images)
+            list(pool.map(crop_best_object, images, object_infos))
+    batched_time = time.perf_counter() - start
+
+    print(f"Per-image loop: {len(image_paths) / per_image_time:.2f} images/s")
+    print(f"Batched pipeline (batch_size={batch_size}, num_threads={num_threads}): "
+          f"{len(image_paths) / batched_time:.2f} images/s")
 
 
 if __name__ == '__main__':
 
-    segment_images(input_directories, output_directory, model_file,
-                   save_as_flat_files=True, best_mask_based_on_area=False)
+    if benchmark:
+        benchmark_against_per_image_loop(input_directories, model_files['pointrend'], benchmark_sample_size)
+    elif benchmark_masks:
+        benchmark_mask_post_processing()
+    elif instances == 'all' and output_format != 'masks':
+        raise ValueError("instances = 'all' needs output_format = 'masks', instances are materialised from the store")
+    elif materialise_only:
+        if instances == 'all':
+            materialise_instances(output_directory, overwrite=True)
+        else:
+            materialise_crops(output_directory, best_mask_based_on_area=False, overwrite=True)
+    else:
+        segment_images(input_directories, output_directory, backend, model_files[backend], detector_file,
+                       save_as_flat_files=True, best_mask_based_on_area=False, num_processes=num_processes,
+                       output_format=output_format, cache_dir=cache_dir)
+        if instances == 'all':
+            materialise_instances(output_directory)
+        elif output_format == 'masks':
+            materialise_crops(output_directory, best_mask_based_on_area=False)
@@ -0,0 +1,92 @@
+import cv2
+import numpy as np
+import torch
+
+#### Docs:
+# Multi-animal posts for bulk-segment-and-clip.py: a post with two dogs must give two identities, not one.
+# 1. Every target object above the score threshold is an instance (not only the best object of an image)
+# 2. Posts where every image has at most one instance are one animal, as before, no model is needed
+# 3. Other posts: instances are embedded with OSNet and associated greedily image by image: an instance joins the most
+#    similar animal seen so far if cosine similarity with its mean embedding is above the threshold, else starts
+#    a new animal. Instances of the same image are always different animals.
+
+EMBEDDING_SIZE = (256, 128)  # (height, width) of the Re-ID model input
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+def select_instances(object_info, score_threshold, max_instances=None):
+    """
+    Returns:
+        list: Indices of objects with score >= score_threshold, by score descending.
+    """
+    indices = [int(i) for i in np.argsort(object_info['scores'])[::-1]
+               if object_info['scores'][i] >= score_threshold]
+    return indices[:max_instances] if max_instances is not None else indices
+
+
+class InstanceEmbedder:
+    def __init__(self, model_path=None, num_classes=1, device='cpu'):
+        import torchreid
+        if model_path is None:
+            self.model = torchreid.models.build_model(name='osnet_x0_25', num_classes=1, loss='triplet',
+                                                      pretrained=True)
+        else:
+            self.model = torchreid.models.build_model(name='osnet_x1_0', num_classes=num_classes, loss='triplet',
+                                                      pretrained=False)
+            self.model.load_state_dict(torch.load(model_path, map_location=device)['state_dict'])
+        self.model = self.model.to(device)
+        self.model.eval()
+        self.device = device
+
+    def embed(self, crops):
+        """
+        Args:
+            crops (list): BGR crops of instances.
+
+        Returns:
+            np.ndarray: L2-normalised embeddings, (len(crops), dim).
+        """
+        height, width = EMBEDDING_SIZE
+        batch = np.stack([cv2.resize(crop, (width, height), interpolation=cv2.INTER_AREA)[:, :, ::-1]
+                          for crop in crops]).astype(np.float32) / 255
+        batch = torch.from_numpy(((batch - IMAGENET_MEAN) / IMAGENET_STD).transpose(0, 3, 1, 2))
+        with torch.no_grad():
+            features = self.model(batch.to(self.device))
+        return torch.nn.functional.normalize(features, dim=1).cpu().numpy()
+
+
+def associate_instances(instances_per_image, embeddings, similarity_threshold):
+    """
+    Args:
+        instances_per_image (list): Number of instances of every image of a post, embeddings go in the same order.
+        embeddings (np.ndarray): L2-normalised embeddings of all instances of the post.
+        similarity_threshold (float): Min cosine similarity of an instance with an animal to join it.
+
+    Returns:
+        np.ndarray: Animal index (from 0) of every instance.
+    """
+    animals = np.full(len(embeddings), -1, dtype=np.int64)
+    sums = np.empty((0, embeddings.shape[1]), dtype=np.float32)
+    offset = 0
+    for count in instances_per_image:
+        rows = np.arange(offset, offset + count)
+        offset += count
+        if len(sums):
+            centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+            similarities = embeddings[rows] @ centroids.T
+            taken = set()
+            # Most similar (instance, animal) pairs first, every animal takes one instance per image
+            for flat_ind in np.argsort(similarities, axis=None)[::-1]:
+                row_ind, animal = np.unravel_index(flat_ind, similarities.shape)
+                if similarities[row_ind, animal] < similarity_threshold:
+                    break
+                if animals[rows[row_ind]] == -1 and animal not in taken:
+                    animals[rows[row_ind]] = animal
+                    taken.add(animal)
+        for row in rows:
+            if animals[row] == -1:
+                animals[row] = len(sums)
+                sums = np.vstack([sums, np.zeros((1, embeddings.shape[1]), dtype=np.float32)])
+            sums[animals[row]] += embeddings[row]
+    return animals
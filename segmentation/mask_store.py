@@ -0,0 +1,79 @@
+import os
+import glob
+import json
+import numpy as np
+from pycocotools import mask as mask_util
+
+#### Docs:
+# Mask store for bulk-segment-and-clip.py: segmentation results are kept instead of only the clipped JPEGs,
+# so a new crop policy costs an image decode and a mask decode per image, not a model run.
+# Every segmenting process appends to its own masks_<shard>.jsonl in the output dir, one line per image:
+#   {"image": raw image path, "file_name": output path relative to the output dir, "height": H, "width": W,
+#    "objects": [{"bbox": [x, y, w, h], "class_id": COCO id, "score": .., "area": mask pixels,
+#                 "segmentation": COCO RLE {"size": [H, W], "counts": str}}, ...]}
+# Boxes are in COCO format, as in yolov8_segment_with_annotations.py. Masks are decoded lazily, only the selected one.
+
+STORE_PREFIX = 'masks_'
+
+
+def store_path(store_dir, shard_ind):
+    return os.path.join(store_dir, f"{STORE_PREFIX}{shard_ind}.jsonl")
+
+
+def encode_objects(image_path, file_name, object_info):
+    masks = np.asfortranarray(object_info['masks'].astype(np.uint8))
+    rles = mask_util.encode(masks) if masks.shape[2] else []
+    height, width = masks.shape[:2]
+    objects = []
+    for (x1, y1, x2, y2), class_id, score, rle in zip(object_info['boxes'].tolist(), object_info['class_ids'].tolist(),
+                                                      object_info['scores'].tolist(), rles):
+        objects.append({
+            'bbox': [x1, y1, x2 - x1, y2 - y1],
+            'class_id': class_id,
+            'score': round(score, 4),
+            'area': int(mask_util.area(rle)),
+            'segmentation': {'size': rle['size'], 'counts': rle['counts'].decode('ascii')},
+        })
+    return {'image': image_path, 'file_name': file_name, 'height': height, 'width': width, 'objects': objects}
+
+
+def read_mask_store(store_dir):
+    """
+    Returns:
+        dict: Raw image path -> record (see Docs above), the last record wins if an image was segmented twice.
+    """
+    records = {}
+    for path in sorted(glob.glob(os.path.join(store_dir, f"{STORE_PREFIX}*.jsonl"))):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):  # Torn by a crash, the image is segmented again on resume
+                    continue
+                record = json.loads(line)
+                records[record['image']] = record
+    return records
+
+
+class LazyMasks:
+    """
+    Stands in for the (H, W, N) masks array of object info, masks[:, :, i] decodes only the i-th RLE.
+    """
+
+    def __init__(self, record):
+        self.rles = [obj['segmentation'] for obj in record['objects']]
+        self.shape = (record['height'], record['width'], len(self.rles))
+
+    def __getitem__(self, key):
+        *_, idx = key
+        return mask_util.decode(self.rles[idx]).astype(bool)
+
+
+def to_object_info(record):
+    objects = record['objects']
+    return {
+        'boxes': np.array([[x, y, x + w, y + h] for x, y, w, h in (obj['bbox'] for obj in objects)],
+                          dtype=int).reshape(-1, 4),
+        'class_ids': np.array([obj['class_id'] for obj in objects], dtype=int),
+        'scores': np.array([obj['score'] for obj in objects], dtype=np.float32),
+        'areas': np.array([obj['area'] for obj in objects], dtype=np.int64),
+        'masks': LazyMasks(record),
+    }
@@ -0,0 +1,60 @@
+import os
+import json
+import hashlib
+import tempfile
+
+#### Docs:
+# Content-addressed cache of segmentation results for bulk-segment-and-clip.py, so moving or re-splitting the raw
+# dataset (_part_N, clustered_part_N, ...) never makes us segment the same photo twice.
+# - Key of a result: sha1 of the image file bytes, paths don't matter
+# - Results of different setups are kept apart in <cache_dir>/<setup key>/, the setup key is a hash of the backend,
+#   model file contents, detector file contents, target classes and confidence
+# - A result is a mask store record without paths (see mask_store.py): {"height", "width", "objects"},
+#   one file per image in <setup key>/<first 2 hex digits>/<sha1>.json, written atomically so processes can share it
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_digest(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def setup_key(backend, model_path, detector_path, target_classes, confidence):
+    setup = {
+        'backend': backend,
+        # Ultralytics downloads known model names on first use, so a missing file is keyed by its name
+        'model': file_digest(model_path) if os.path.exists(model_path) else model_path,
+        'detector': (file_digest(detector_path) if detector_path is not None and os.path.exists(detector_path)
+                     else detector_path),
+        'target_classes': sorted(target_classes),
+        'confidence': confidence,
+    }
+    return hashlib.sha1(json.dumps(setup, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+class SegmentationCache:
+    def __init__(self, cache_dir, key):
+        self.dir = os.path.join(cache_dir, key)
+
+    def path(self, digest):
+        return os.path.join(self.dir, digest[:2], f"{digest}.json")
+
+    def get(self, digest):
+        try:
+            with open(self.path(digest), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, digest, record):
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A unique temp file per call: threads of one process put the same digest for byte-identical reposts
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'height': record['height'], 'width': record['width'], 'objects': record['objects']}, f)
+        os.replace(tmp_path, path)
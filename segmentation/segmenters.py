@@ -0,0 +1,215 @@
+import cv2
+import numpy as np
+import torch
+
+#### Docs:
+# Batched segmentation backends for bulk-segment-and-clip.py, created by build_segmenter(backend, ...).
+# Every backend has segment_batch(images) -> object info per image, so mask selection and cropping don't depend on it.
+# - pointrend: PixelLib PointRend (resnet50), slow on CPU but precise mask borders.
+#   PixelLib's segmentImage reads the file itself and runs the model on one image at a time, so we go one level lower:
+#   images are decoded once by the caller, resized here to the model input size and run through the PointRend
+#   model in batches. Masks are returned at the original image resolution in the same format as PixelLib's
+#   segmentImage object info, so mask selection and cropping code works with both.
+# - yolov8: Ultralytics YOLOv8-seg (e.g. yolov8n-seg.pt), an order of magnitude faster on CPU, coarser masks.
+# Any backend can be made two-stage by passing detector_path (a YOLOv8 detection model, e.g. yolov8n.pt):
+# the detector finds target boxes on a low resolution copy, then the mask model only runs on the box crops
+# (plus a margin) at full resolution. Large VK originals cost about as much as their animals, and small animals
+# get the whole model input instead of a few dozen pixels of it.
+
+# Contiguous COCO ids, same for PointRend (detectron2) and YOLO models
+COCO_ANIMAL_CLASS_IDS = {'bird': 14, 'cat': 15, 'dog': 16, 'horse': 17, 'sheep': 18, 'cow': 19, 'bear': 21}
+
+
+class PointRendSegmenter:
+    def __init__(self, model_path, target_classes, confidence=0.5, min_size=None, max_size=None):
+        from pixellib.torchbackend.instance import instanceSegmentation
+        self.segmenter = instanceSegmentation()
+        self.segmenter.load_model(model_path, confidence=confidence)
+        predictor = self.segmenter.predictor
+        self.model = predictor.model
+        self.input_format = predictor.input_format
+        # Input resolution, the model's config (800/1333) unless given
+        self.min_size = min_size or predictor.cfg.INPUT.MIN_SIZE_TEST
+        self.max_size = max_size or predictor.cfg.INPUT.MAX_SIZE_TEST
+        self.target_class_ids = np.array([COCO_ANIMAL_CLASS_IDS[c] for c in target_classes])
+
+    def preprocess(self, image):
+        # Same as the predictor's ResizeShortestEdge, but INTER_AREA is much cheaper for big VK originals
+        height, width = image.shape[:2]
+        scale = min(self.min_size / min(height, width), self.max_size / max(height, width))
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        resized = cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=interpolation)
+        if self.input_format == 'RGB':
+            resized = resized[:, :, ::-1]
+        # 'height'/'width' make the model paste masks back at the original resolution
+        return {'image': torch.as_tensor(np.ascontiguousarray(resized.transpose(2, 0, 1))),
+                'height': height, 'width': width}
+
+    def segment_batch(self, images):
+        """
+        Args:
+            images (list): BGR images as decoded by cv2.imread.
+
+        Returns:
+            list: Object info per image: 'boxes' (N, 4) xyxy, 'class_ids' (N,), 'scores' (N,), 'masks' (H, W, N) bool,
+            'areas' (N,) mask pixels, target classes only.
+        """
+        inputs = [self.preprocess(image) for image in images]
+        with torch.no_grad():
+            outputs = self.model(inputs)
+        return [self.to_object_info(output['instances'].to('cpu')) for output in outputs]
+
+    def to_object_info(self, instances):
+        class_ids = instances.pred_classes.numpy()
+        is_target = np.isin(class_ids, self.target_class_ids)
+        # (N, H, W) -> (H, W, N) is a view, masks[:, :, i] stays a contiguous plane
+        masks = instances.pred_masks.numpy()[is_target]
+        return {
+            'boxes': instances.pred_boxes.tensor.numpy()[is_target].astype(int),
+            'class_ids': class_ids[is_target],
+            'scores': instances.scores.numpy()[is_target],
+            'masks': masks.transpose(1, 2, 0),
+            'areas': np.count_nonzero(masks.reshape(len(masks), -1), axis=1),
+        }
+
+
+def yolo_target_class_ids(model, target_classes):
+    """
+    Maps model class ids of target classes to COCO ids by class name, so custom trained models
+    (e.g. dog_detection_model.pt with the only class 0: dog) work and report the same ids as COCO ones.
+
+    Returns:
+        dict: Model class id -> COCO id.
+    """
+    return {model_id: COCO_ANIMAL_CLASS_IDS[name] for model_id, name in model.names.items() if name in target_classes}
+
+
+class YoloSegmenter:
+    def __init__(self, model_path, target_classes, confidence=0.5, image_size=640):
+        from ultralytics import YOLO
+        self.model = YOLO(model_path)
+        self.confidence = confidence
+        self.image_size = image_size
+        self.model_to_coco_ids = yolo_target_class_ids(self.model, target_classes)
+
+    def segment_batch(self, images):
+        """
+        Args:
+            images (list): BGR images as decoded by cv2.imread.
+
+        Returns:
+            list: Object info per image, same as PointRendSegmenter.segment_batch.
+        """
+        # retina_masks upsamples masks to the original image resolution, as PointRend does
+        results = self.model.predict(images, conf=self.confidence, imgsz=self.image_size,
+                                     classes=list(self.model_to_coco_ids), retina_masks=True, verbose=False)
+        return [self.to_object_info(result, image.shape[:2]) for result, image in zip(results, images)]
+
+    def to_object_info(self, result, image_shape):
+        boxes = result.boxes.cpu()
+        if result.masks is None:
+            masks = np.zeros((0, *image_shape), dtype=bool)
+        else:
+            masks = result.masks.data.cpu().numpy() > 0.5
+        return {
+            'boxes': boxes.xyxy.numpy().astype(int),
+            'class_ids': np.array([self.model_to_coco_ids[c] for c in boxes.cls.numpy().astype(int)], dtype=int),
+            'scores': boxes.conf.numpy(),
+            'masks': masks.transpose(1, 2, 0),
+            'areas': np.count_nonzero(masks.reshape(len(masks), -1), axis=1),
+        }
+
+
+class YoloDetector:
+    def __init__(self, model_path, target_classes, confidence=0.25, image_size=320):
+        from ultralytics import YOLO
+        self.model = YOLO(model_path)
+        self.confidence = confidence
+        self.image_size = image_size
+        self.model_to_coco_ids = yolo_target_class_ids(self.model, target_classes)
+
+    def detect_batch(self, images):
+        """
+        Returns:
+            list: (boxes (N, 4) xyxy in original image coordinates, class_ids (N,), scores (N,)) per image.
+        """
+        results = self.model.predict(images, conf=self.confidence, imgsz=self.image_size,
+                                     classes=list(self.model_to_coco_ids), verbose=False)
+        detections = []
+        for result in results:
+            boxes = result.boxes.cpu()
+            class_ids = np.array([self.model_to_coco_ids[c] for c in boxes.cls.numpy().astype(int)], dtype=int)
+            detections.append((boxes.xyxy.numpy().astype(int), class_ids, boxes.conf.numpy()))
+        return detections
+
+
+class TwoStageSegmenter:
+    def __init__(self, detector, mask_segmenter, box_margin=0.15):
+        self.detector = detector
+        self.mask_segmenter = mask_segmenter
+        self.box_margin = box_margin  # Share of the box size added on every side, masks need some context
+
+    def crop_region(self, box, image_shape):
+        height, width = image_shape
+        x1, y1, x2, y2 = box
+        margin_x, margin_y = int((x2 - x1) * self.box_margin), int((y2 - y1) * self.box_margin)
+        return max(0, x1 - margin_x), max(0, y1 - margin_y), min(width, x2 + margin_x), min(height, y2 + margin_y)
+
+    def segment_batch(self, images):
+        """
+        Returns:
+            list: Object info per image, same as PointRendSegmenter.segment_batch, one object per detected box
+            the mask model found a target object in. Scores and classes are the detector's.
+        """
+        crops, crop_sources = [], []
+        for image_ind, (image, (boxes, class_ids, scores)) in enumerate(zip(images, self.detector.detect_batch(images))):
+            for box, class_id, score in zip(boxes, class_ids, scores):
+                x1, y1, x2, y2 = self.crop_region(box, image.shape[:2])
+                if x2 - x1 < 2 or y2 - y1 < 2:
+                    continue
+                crops.append(image[y1:y2, x1:x2])
+                crop_sources.append((image_ind, (x1, y1, x2, y2), box, class_id, score))
+        crop_infos = self.mask_segmenter.segment_batch(crops) if crops else []
+
+        objects = [[] for _ in images]
+        for (image_ind, region, box, class_id, score), crop_info in zip(crop_sources, crop_infos):
+            if len(crop_info['scores']) == 0:
+                continue
+            # The crop may contain parts of neighbours, the detected animal is the most confident mask
+            crop_mask = crop_info['masks'][:, :, int(np.argmax(crop_info['scores']))]
+            objects[image_ind].append((region, crop_mask, box, class_id, score))
+        return [self.to_object_info(image.shape[:2], image_objects) for image, image_objects in zip(images, objects)]
+
+    @staticmethod
+    def to_object_info(image_shape, image_objects):
+        masks = np.zeros((*image_shape, len(image_objects)), dtype=bool)
+        for i, ((x1, y1, x2, y2), crop_mask, _, _, _) in enumerate(image_objects):
+            masks[y1:y2, x1:x2, i] = crop_mask
+        return {
+            'boxes': np.array([box for _, _, box, _, _ in image_objects], dtype=int).reshape(-1, 4),
+            'class_ids': np.array([class_id for _, _, _, class_id, _ in image_objects], dtype=int),
+            'scores': np.array([score for _, _, _, _, score in image_objects], dtype=np.float32),
+            'masks': masks,
+            'areas': np.array([np.count_nonzero(crop_mask) for _, crop_mask, _, _, _ in image_objects], dtype=np.int64),
+        }
+
+
+SEGMENTERS = {'pointrend': PointRendSegmenter, 'yolov8': YoloSegmenter}
+
+
+def build_segmenter(backend, model_path, target_classes, confidence=0.5, detector_path=None, **backend_kwargs):
+    """
+    Args:
+        backend (str): Mask model backend, see SEGMENTERS.
+        model_path (str): Mask model file of the backend.
+        target_classes (list): Class names from COCO_ANIMAL_CLASS_IDS.
+        confidence (float): Min score of the mask model.
+        detector_path (str): YOLOv8 detection model to make the segmenter two-stage, None for full-image segmentation.
+        **backend_kwargs: Passed to the backend, e.g. image_size for yolov8, min_size/max_size for pointrend.
+    """
+    if backend not in SEGMENTERS:
+        raise ValueError(f"Unknown segmentation backend: {backend}, expected one of {list(SEGMENTERS)}")
+    segmenter = SEGMENTERS[backend](model_path, target_classes, confidence=confidence, **backend_kwargs)
+    if detector_path is not None:
+        segmenter = TwoStageSegmenter(YoloDetector(detector_path, target_classes), segmenter)
+    return segmenter
@@ -4,6 +4,7 @@ import os
 import cv2
 from ultralytics import YOLO
 from pycocotools import mask as mask_util
+from segmentation.append_log import truncate_torn_line
 
 # Load YOLO segmentation model (yolov8n-seg.pt)
 model = YOLO('yolov8n-seg.pt')
@@ -12,22 +13,22 @@ model = YOLO('yolov8n-seg.pt')
 image_folder = os.path.join('data', 'filtered_imgs')
 save_folder = os.path.join('data', 'segmented_imgs')
 annotation_file = os.path.join('data', 'annotations_coco.json')
+# Annotations are streamed here, one JSON line per processed image, and merged into annotation_file at the end.
+# Images already in it are skipped, so an interrupted run resumes where it stopped
+annotation_lines_file = os.path.join('data', 'annotations_coco.jsonl')
+batch_size = 16  # Images per model call
 
 # Ensure the save folder exists
 if not os.path.exists(save_folder):
     os.makedirs(save_folder)
 
-# Initialize annotations dictionary in COCO format
-annotations = {
-    "images": [],
-    "annotations": [],
-    "categories": [
-        {"id": 1, "name": "dog"},
-        {"id": 2, "name": "cat"}
-    ]
-}
+# COCO class ids of the model -> category ids of our annotations
+categories = [
+    {"id": 1, "name": "dog"},
+    {"id": 2, "name": "cat"}
+]
+category_ids = {16: 1, 15: 2}
 
-annotation_id = 1
 
 # Function to convert numpy array or bytes to serializable format
 def convert_to_serializable(obj):
@@ -37,74 +38,98 @@ def convert_to_serializable(obj):
         return obj.decode()  # Decode bytes to string
     raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
 
-# Process each image in the folder
-for image_id, image_name in enumerate(os.listdir(image_folder)):
-    # Full path to the image
-    image_path = os.path.join(image_folder, image_name)
 
-    # Run the image through the model
-    results = model(image_path)
-
-    # Load the image with OpenCV
-    img = cv2.imread(image_path)
-    height, width, _ = img.shape
-
-    # Add image info to the COCO-style annotations
-    annotations["images"].append({
-        "id": image_id,
-        "file_name": image_name,
-        "height": height,
-        "width": width
-    })
+def annotate_result(result):
+    # The image as decoded by the model, no second cv2.imread
+    img = result.orig_img.copy()
+    height, width = result.orig_shape
+    image_annotations = []
 
     # Loop through each detected object
-    for result in results:
-        if result.masks:  # Check if masks exist in the predictions
-            for mask, box in zip(result.masks.data, result.boxes):
-                class_id = int(box.cls[0])  # Get the class ID
-
-                # Check if it's a dog or cat (16 for dog, 17 for cat)
-                if class_id in [16, 17]:
-                    # Set the category ID (1 for dog, 2 for cat)
-                    category_id = 1 if class_id == 16 else 2
-
-                    # Convert mask to numpy array
-                    mask = mask.cpu().numpy()
-
-                    # Resize mask to the image size
-                    mask_resized = cv2.resize(mask, (width, height))
-
-                    # Apply the mask to the image (visualization purposes)
-                    img[mask_resized > 0.5] = [0, 255, 0]  # Green color for segmented areas
-
-                    # Use pycocotools to encode the mask into RLE format
-                    rle = mask_util.encode(np.asfortranarray((mask_resized > 0.5).astype(np.uint8)))
-
-                    # Get bounding box coordinates and convert to COCO format
-                    x1, y1, x2, y2 = map(int, box.xyxy[0])  # Bounding box coordinates
-                    bbox = [x1, y1, x2 - x1, y2 - y1]  # COCO format: [x_min, y_min, width, height]
-
-                    # Convert mask area to a serializable float value
-                    area = float(np.sum(mask_resized))
-
-                    # Add the annotation in COCO format
-                    annotations["annotations"].append({
-                        "id": annotation_id,
-                        "image_id": image_id,
-                        "category_id": category_id,
-                        "segmentation": rle,  # Store the RLE-encoded mask
-                        "bbox": bbox,
-                        "area": area,
-                        "iscrowd": 0  # Set 'iscrowd' to 0 for individual objects
-                    })
+    if result.masks:  # Check if masks exist in the predictions
+        # retina_masks: masks are already at the original image size
+        masks = result.masks.data.cpu().numpy() > 0.5
+        for mask, box in zip(masks, result.boxes):
+            category_id = category_ids[int(box.cls[0])]
+
+            # Apply the mask to the image (visualization purposes)
+            img[mask] = [0, 255, 0]  # Green color for segmented areas
+
+            # Use pycocotools to encode the mask into RLE format
+            rle = mask_util.encode(np.asfortranarray(mask.astype(np.uint8)))
+
+            # Get bounding box coordinates and convert to COCO format
+            x1, y1, x2, y2 = map(int, box.xyxy[0])  # Bounding box coordinates
+            bbox = [x1, y1, x2 - x1, y2 - y1]  # COCO format: [x_min, y_min, width, height]
+
+            # Ids are assigned when merging, so lines don't depend on the order images were processed in
+            image_annotations.append({
+                "category_id": category_id,
+                "segmentation": rle,  # Store the RLE-encoded mask
+                "bbox": bbox,
+                "area": float(mask_util.area(rle)),
+                "iscrowd": 0  # Set 'iscrowd' to 0 for individual objects
+            })
+
+    image_info = {"file_name": os.path.basename(result.path), "height": height, "width": width}
+    return img, image_info, image_annotations
+
+
+def read_annotated_file_names():
+    annotated = set()
+    if os.path.exists(annotation_lines_file):
+        with open(annotation_lines_file, 'r') as f:
+            for line in f:
+                if line.endswith('\n'):  # The last line may be torn by a crash
+                    annotated.add(json.loads(line)["image"]["file_name"])
+    return annotated
+
+
+def merge_annotation_lines():
+    # Two passes over the lines instead of loading them, memory doesn't grow with the dataset
+    with open(annotation_file, 'w') as out:
+        out.write('{"images": [')
+        with open(annotation_lines_file, 'r') as f:
+            lines = (line for line in f if line.endswith('\n'))
+            for image_id, line in enumerate(lines):
+                image_info = json.loads(line)["image"]
+                out.write((", " if image_id else "") + json.dumps({"id": image_id, **image_info}))
+        out.write('], "annotations": [')
+        annotation_id = 1
+        with open(annotation_lines_file, 'r') as f:
+            lines = (line for line in f if line.endswith('\n'))
+            for image_id, line in enumerate(lines):
+                for annotation in json.loads(line)["annotations"]:
+                    out.write((", " if annotation_id > 1 else "") +
+                              json.dumps({"id": annotation_id, "image_id": image_id, **annotation}))
                     annotation_id += 1
+        out.write('], "categories": ' + json.dumps(categories) + '}')
+
+
+# Process the images in the folder that aren't annotated yet, in batches
+annotated = read_annotated_file_names()
+image_names = sorted(name for name in os.listdir(image_folder) if name not in annotated)
+print(f"{len(annotated)} images are already annotated, {len(image_names)} to go.")
+
+truncate_torn_line(annotation_lines_file)
+with open(annotation_lines_file, 'a') as lines_file:
+    for i in range(0, len(image_names), batch_size):
+        batch_paths = [os.path.join(image_folder, name) for name in image_names[i:i + batch_size]]
+
+        # Run the batch through the model, dogs and cats only
+        results = model(batch_paths, classes=list(category_ids), retina_masks=True, verbose=False)
+
+        for result in results:
+            img, image_info, image_annotations = annotate_result(result)
+
+            # Save the image with the applied mask
+            cv2.imwrite(os.path.join(save_folder, image_info["file_name"]), img)
 
-    # Save the image with the applied mask
-    save_path = os.path.join(save_folder, image_name)
-    cv2.imwrite(save_path, img)
+            lines_file.write(json.dumps({"image": image_info, "annotations": image_annotations},
+                                        default=convert_to_serializable) + '\n')
+        lines_file.flush()
 
 # Save the COCO annotations to a JSON file
-with open(annotation_file, 'w') as f:
-    json.dump(annotations, f, default=convert_to_serializable)
+merge_annotation_lines()
 
 print("Segmentation completed and annotations saved in COCO format")